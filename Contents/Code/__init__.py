@@ -15,10 +15,36 @@
 import logging
 
 import music
+from artcache import ArtCache, is_allowed
+from utils import get_image_url_for_view, set_image_size
 
 PREFIX = '/music/gmusic'
 SOURCE = "Google Music"
 DB_NAME = "pickles"
+SESSIONS_NAME = "sessions"
+
+# The number of tracks listed as recently added
+RECENT_COUNT = 100
+
+# How often to check whether any part of the library is due for an update.
+REFRESH_INTERVAL = 60
+
+# Images are served through a local cache of at most this many bytes.
+ART_CACHE_SIZE = 200 * 1024 * 1024
+
+# The preference controlling the requested image size for each view type.
+IMAGE_SIZE_PREFS = [
+    ("list", "listthumbsize"),
+    ("grid", "gridthumbsize"),
+    ("art", "artsize"),
+]
+
+# The preferences for each account. The position is used as the library ID.
+ACCOUNTS = [
+    ("username", "password"),
+    ("username2", "password2"),
+    ("username3", "password3"),
+]
 
 
 def smart_sort(list):
@@ -62,25 +88,97 @@ logger = logging.getLogger("googlemusicchannel.channel")
 music.bugfix_album(AlbumObject)
 
 
-def url_or_default(url, default):
+# Provides the art cache with access to the plugin's data store.
+class DataStorage(object):
+    def exists(self, name):
+        return Data.Exists(name)
+
+    def load(self, name):
+        return Data.Load(name)
+
+    def save(self, name, data):
+        Data.Save(name, data)
+
+    def remove(self, name):
+        Data.Remove(name)
+
+    def load_object(self, name):
+        return Data.LoadObject(name)
+
+    def save_object(self, name, obj):
+        Data.SaveObject(name, obj)
+
+art_cache = None
+
+
+# Images are served through the local art cache at a size suited to where
+# they are displayed. Lists use small thumbnails, grids larger ones. The cache
+# only fetches from Google's image hosts so other images are linked directly.
+def image_for_view(url, view):
+    url = get_image_url_for_view(url, view)
+    if is_allowed(url):
+        return Callback(Artwork, url=url)
+    return url
+
+
+def thumb_or_default(url, default, view="list"):
     if url is not None:
-        return url
+        return image_for_view(url, view)
     return default
 
 
-def refresh():
-    data = music.refresh()
+def art_or_default(url, default):
+    if url is not None:
+        return image_for_view(url, "art")
+    return default
+
+
+def prefetch_art(urls):
+    art_cache.prefetch(urls)
+
+
+# Long updates periodically save their progress over the normal data.
+def save_checkpoint(data):
     Data.SaveObject(DB_NAME, data)
 
-    Thread.CreateTimer(60 * 10, refresh)
+
+def refresh():
+    try:
+        data = music.refresh()
+        if data is not None:
+            Data.SaveObject(DB_NAME, data)
+
+            urls = map(lambda a: get_image_url_for_view(a.thumb, "grid"),
+                       music.added_albums)
+            if len(urls) > 0:
+                Thread.Create(prefetch_art, urls=urls)
+
+        # Clients may have logged in since the last save
+        if music.sessions_changed():
+            Data.SaveObject(SESSIONS_NAME, music.pickle_sessions())
+    except:
+        logger.exception("Failed to refresh.")
+
+    Thread.CreateTimer(REFRESH_INTERVAL, refresh)
+
+
+def load_image_sizes():
+    for (view, pref) in IMAGE_SIZE_PREFS:
+        if Prefs[pref]:
+            set_image_size(view, Prefs[pref])
 
 
 def login():
-    music.set_credentials(Prefs["username"], Prefs["password"])
+    music.set_credentials([(Prefs[u], Prefs[p]) for (u, p) in ACCOUNTS])
 
 
 def Start():
+    global art_cache
+
     logger.debug("Start called for %s %s" % (Prefs["username"], Prefs["password"]))
+    art_cache = ArtCache(DataStorage(), ART_CACHE_SIZE)
+    load_image_sizes()
+
     if Data.Exists(DB_NAME):
         try:
             data = Data.LoadObject(DB_NAME)
@@ -89,6 +187,13 @@ def Start():
             logger.exception("Failed to load initial data.")
 
     login()
+    music.set_checkpoint_saver(save_checkpoint)
+
+    if Data.Exists(SESSIONS_NAME):
+        try:
+            music.load_sessions(Data.LoadObject(SESSIONS_NAME))
+        except:
+            logger.exception("Failed to load saved sessions.")
 
     Thread.Create(refresh)
 
@@ -100,6 +205,7 @@ def Start():
 
 def ValidatePrefs():
     logger.debug("Validate called for %s" % Prefs["username"])
+    load_image_sizes()
     login()
 
 
@@ -107,10 +213,31 @@ def ValidatePrefs():
 def Main():
     oc = ObjectContainer(content=ContainerContent.Mixed)
 
-    library = music.get_library(0)
-    if library is None:
+    libraries = music.get_libraries()
+    if len(libraries) == 1:
+        add_library_items(oc, libraries[0])
         return oc
 
+    for library in libraries:
+        oc.add(DirectoryObject(
+            key=Callback(LibraryRoot, libraryId=library.id),
+            title=library.username,
+            thumb=R("library.png")
+        ))
+
+    return oc
+
+
+@route(PREFIX + "/root")
+def LibraryRoot(libraryId):
+    library = music.get_library(libraryId)
+    oc = ObjectContainer(content=ContainerContent.Mixed, title2=library.username)
+
+    add_library_items(oc, library)
+    return oc
+
+
+def add_library_items(oc, library):
     oc.add(DirectoryObject(
         key=Callback(Library, libraryId=library.id),
         title=L("library"),
@@ -123,22 +250,25 @@ def Main():
         thumb=R("situations.png")
     ))
 
-    return oc
+
+@route(PREFIX + "/art")
+def Artwork(url):
+    (data, type) = art_cache.get(url)
+    return DataObject(data, type)
 
 
 @route(PREFIX + "/glibrary/situations")
 def Situations(libraryId):
-    library = music.get_library(0)
+    library = music.get_library(libraryId)
     oc = ObjectContainer(content=ContainerContent.Mixed, art=R("situations.png"),
                          title2=L("situations"))
 
     situations = library.get_listen_situations()
     for situation in situations:
         oc.add(DirectoryObject(
-            key=Callback(LibrarySituation, libraryId=library.id,
-                         situation=JSON.StringFromObject(situation)),
+            key=Callback(LibrarySituation, libraryId=library.id, situationId=situation["id"]),
             title=situation["title"],
-            thumb=situation["imageUrl"]
+            thumb=thumb_or_default(situation["imageUrl"], R("situations.png"))
         ))
 
     return oc
@@ -179,6 +309,12 @@ def Library(libraryId):
         thumb=R("track.png")
     ))
 
+    oc.add(DirectoryObject(
+        key=Callback(LibraryRecent, libraryId=libraryId),
+        title=L("library_recent"),
+        thumb=R("track.png")
+    ))
+
     oc.add(DirectoryObject(
         key=Callback(LibraryGenres, libraryId=libraryId),
         title=L("library_genres"),
@@ -189,29 +325,32 @@ def Library(libraryId):
 
 
 @route(PREFIX + "/glibrary/situation")
-def LibrarySituation(libraryId, situation):
-    situation=JSON.ObjectFromString(situation)
+def LibrarySituation(libraryId, situationId):
+    library = music.get_library(libraryId)
+    situation = library.get_listen_situation(situationId)
+    if situation is None:
+        return ObjectContainer(title2=L("situations"))
+
     oc = ObjectContainer(
         title2=situation["title"],
         content=ContainerContent.Playlists,
-        art=situation["wideImageUrl"],
+        art=art_or_default(situation["wideImageUrl"], R("situations.png")),
     )
 
     if "stations" in situation:
         for station in situation["stations"]:
             oc.add(DirectoryObject(
                 key=Callback(GetStation, libraryId=libraryId, type="curated_station",
-                             objectId=station["id"], name=station["name"], art=station["name"]),
+                             objectId=station["id"], name=station["name"], art=station["art"]),
                 title=station["name"],
-                thumb=station["thumb"]
+                thumb=thumb_or_default(station["thumb"], R("station.png"))
             ))
     elif "situations" in situation:
         for situation in situation["situations"]:
             oc.add(DirectoryObject(
-                key=Callback(LibrarySituation, libraryId=libraryId,
-                             situation=JSON.StringFromObject(situation)),
+                key=Callback(LibrarySituation, libraryId=libraryId, situationId=situation["id"]),
                 title=situation["title"],
-                thumb=situation["imageUrl"]
+                thumb=thumb_or_default(situation["imageUrl"], R("situations.png"))
             ))
 
     return oc
@@ -266,13 +405,14 @@ def LibraryStations(libraryId):
     )
 
     library = music.get_library(libraryId)
-    stations = library.get_stations()
-    for station in smart_sort(stations):
+    stations = smart_sort(library.get_stations())
+    library.prefetch_station_tracks(map(lambda s: s.id, stations))
+    for station in stations:
         oc.add(PlaylistObject(
             key=Callback(LibraryStation, libraryId=libraryId, stationId=station.id,
                          name=station.name, art=station.art),
             title=station.name,
-            thumb=url_or_default(station.thumb, R("station.png"))
+            thumb=thumb_or_default(station.thumb, R("station.png"))
         ))
 
     return oc
@@ -283,22 +423,26 @@ def GetStation(libraryId, type, objectId, name, art):
     library = music.get_library(libraryId)
     kwargs = {}
     kwargs["%s_id" % type] = objectId
-    stationId = library.get_station_id(name, **kwargs)
-    return LibraryStation(libraryId, stationId, name, art)
+    (stationId, tracks) = library.get_seed_station_tracks(name, 50, **kwargs)
+    return station_container(library, name, art, tracks)
 
 
 @route(PREFIX + "/station")
 def LibraryStation(libraryId, stationId, name, art):
     library = music.get_library(libraryId)
+    tracks = library.get_station_tracks(stationId, num_tracks=50)
+    return station_container(library, name, art, tracks)
 
+
+def station_container(library, name, art, tracks):
     oc = ObjectContainer(
         title2=name,
         content=ContainerContent.Tracks,
         view_group="track_list",
-        art=url_or_default(art, R("station.png"))
+        art=art_or_default(art, R("station.png"))
     )
 
-    for track in library.get_station_tracks(stationId, num_tracks=50):
+    for track in tracks:
         oc.add(track_object(library, track))
 
     return oc
@@ -315,12 +459,14 @@ def LibraryArtists(libraryId):
 
     library = music.get_library(libraryId)
     artists = library.get_artists()
+    durations = library.get_artist_durations()
     for artist in smart_sort(artists):
         oc.add(ArtistObject(
             key=Callback(LibraryArtist, libraryId=libraryId, artistId=artist.id),
             rating_key=artist.id,
             title=artist.name,
-            thumb=url_or_default(artist.thumb, R("artist.png"))
+            duration=int(durations.get(artist.key, 0)),
+            thumb=thumb_or_default(artist.thumb, R("artist.png"))
         ))
 
     return oc
@@ -341,7 +487,7 @@ def LibraryAlbums(libraryId):
         oc.add(DirectoryObject(
             key=Callback(LibraryAlbum, libraryId=libraryId, albumId=album.id),
             title=album.name,
-            thumb=url_or_default(album.thumb, R("album.png"))
+            thumb=thumb_or_default(album.thumb, R("album.png"), "grid")
         ))
 
     return oc
@@ -364,6 +510,22 @@ def LibrarySongs(libraryId):
     return oc
 
 
+@route(PREFIX + "/glibrary/recent")
+def LibraryRecent(libraryId):
+    oc = ObjectContainer(
+        title2=L("library_recent"),
+        content=ContainerContent.Tracks,
+        view_group="track_list",
+        art=R("track.png")
+    )
+
+    library = music.get_library(libraryId)
+    for track in library.get_recent_tracks(RECENT_COUNT):
+        oc.add(track_object(library, track))
+
+    return oc
+
+
 @route(PREFIX + "/glibrary/genres")
 def LibraryGenres(libraryId):
     oc = ObjectContainer(
@@ -373,12 +535,14 @@ def LibraryGenres(libraryId):
     )
 
     library = music.get_library(libraryId)
-    genres = library.get_genres()
+    counts = library.get_genre_counts()
+    genres = library.get_genres(counts)
     for genre in genres:
         oc.add(DirectoryObject(
             key=Callback(GenreTracks, libraryId=libraryId, genreName=genre.name),
             title=genre.name,
-            thumb=url_or_default(genre.thumb, R("genre.png"))
+            summary=Locale.LocalStringWithFormat("library_genre_count", counts[genre.key]),
+            thumb=thumb_or_default(genre.thumb, R("genre.png"))
         ))
 
     return oc
@@ -392,7 +556,7 @@ def GenreTracks(libraryId, genreName):
     oc = ObjectContainer(
         title2=genre.name,
         content=ContainerContent.Tracks,
-        art=url_or_default(genre.thumb, R("genre.png"))
+        art=art_or_default(genre.thumb, R("genre.png"))
     )
 
     tracks = library.get_tracks_in_genre(genre)
@@ -410,7 +574,7 @@ def LibraryArtist(libraryId, artistId):
     oc = ObjectContainer(
         title2=artist.name,
         content=ContainerContent.Mixed,
-        art=url_or_default(artist.thumb, R("artist.png"))
+        art=art_or_default(artist.thumb, R("artist.png"))
     )
 
     if artist.id[0:2] != "FA":
@@ -446,7 +610,7 @@ def LibraryArtistAlbums(libraryId, artistId):
         title2=Locale.LocalStringWithFormat("library_artist_album", artist.name),
         content=ContainerContent.Albums,
         view_group="album_list",
-        art=url_or_default(artist.thumb, R("artist.png"))
+        art=art_or_default(artist.thumb, R("artist.png"))
     )
 
     for album in smart_sort(artist.albums):
@@ -454,7 +618,7 @@ def LibraryArtistAlbums(libraryId, artistId):
             key=Callback(LibraryAlbumTracks, libraryId=libraryId, albumId=album.id),
             rating_key=album.id,
             title=album.name,
-            thumb=url_or_default(album.thumb, R("album.png")),
+            thumb=thumb_or_default(album.thumb, R("album.png"), "grid"),
             artist=album.artist.name
         ))
 
@@ -470,7 +634,7 @@ def LibraryArtistTracks(libraryId, artistId):
         title2=Locale.LocalStringWithFormat("library_artist_tracks", artist.name),
         content=ContainerContent.Tracks,
         view_group="track_list",
-        art=url_or_default(artist.thumb, R("artist.png"))
+        art=art_or_default(artist.thumb, R("artist.png"))
     )
 
     all_tracks = []
@@ -494,13 +658,13 @@ def LibraryAlbum(libraryId, albumId):
     oc = ObjectContainer(
         title2=album.name,
         content=ContainerContent.Mixed,
-        art=url_or_default(album.thumb, R("album.png"))
+        art=art_or_default(album.thumb, R("album.png"))
     )
 
     oc.add(DirectoryObject(
         key=Callback(GetStation, libraryId=libraryId, type="album", objectId=album.id,
                      name=Locale.LocalStringWithFormat("library_album_station", album.name),
-                     art=url_or_default(album.art, R("album.png"))),
+                     art=album.art),
         title=Locale.LocalStringWithFormat("library_album_station", album.name),
         thumb=R("station.png")
     ))
@@ -508,7 +672,7 @@ def LibraryAlbum(libraryId, albumId):
     oc.add(DirectoryObject(
         key=Callback(LibraryAlbumTracks, libraryId=libraryId, albumId=album.id),
         title=Locale.LocalStringWithFormat("library_album_tracks", album.name),
-        thumb=url_or_default(album.thumb, R("album.png"))
+        thumb=thumb_or_default(album.thumb, R("album.png"), "grid")
     ))
 
     return oc
@@ -523,7 +687,7 @@ def LibraryAlbumTracks(libraryId, albumId):
         title2=album.name,
         content=ContainerContent.Tracks,
         view_group="track_list",
-        art=url_or_default(album.thumb, R("album.png"))
+        art=art_or_default(album.thumb, R("album.png"))
     )
 
     for track in album.tracks:
@@ -533,11 +697,12 @@ def LibraryAlbumTracks(libraryId, albumId):
 
 
 def track_object(library, track):
+    (title, artist, album, duration, thumb, url) = library.get_track_record(track)
     return TrackObject(
-        url=track.get_url(library),
-        title=track.title,
-        artist=track.artist.name,
-        album=track.album.name,
-        duration=track.duration,
-        thumb=url_or_default(track.thumb, R("track.png"))
+        url=url,
+        title=title,
+        artist=artist,
+        album=album,
+        duration=duration,
+        thumb=thumb_or_default(thumb, R("track.png"))
     )
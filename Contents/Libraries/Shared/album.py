@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import logging
+import __builtin__
 
 from globals import *
 from artist import get_artist_for_album, get_artist_for_track
@@ -20,25 +21,40 @@ from utils import hash, urlize, get_art_for_data, get_thumb_for_data
 
 logger = logging.getLogger("googlemusicchannel.album")
 
+# The IDs of the albums made up for uploaded tracks keyed by (album name,
+# album artist). This saves hashing the same names on every update and is
+# persisted along with the catalog.
+fake_album_ids = {}
 
+
+def get_fake_album_id(name, artist):
+    key = (name, artist)
+    if key not in fake_album_ids:
+        fake_album_ids[key] = "FB%s" % hash("%s:%s" % key)
+    return fake_album_ids[key]
+
+
+# Like tracks, albums hold their artist rather than looking it up by key
 class Album(object):
     data = None
-    artistId = None
+    key = None
+    artist = None
 
-    def __init__(self, data):
+    def __init__(self, data, artist):
         self.data = data
-        album_by_id[self.id] = self
+        self.artist = artist
+        catalog = snapshot()
+        catalog.add_item("album", self)
 
     @classmethod
     def unpickle(cls, data):
-        if data["artistId"] not in artist_by_id:
+        artist = snapshot().get_item("artist", data["artistId"])
+        if artist is None:
             logger.error("Refusing to unpickle album with no valid artist (%s by %s)." %
-                         (data["name"], data["artist"]))
+                         (data["data"]["name"], data["data"].get("artist")))
             return None
 
-        album = cls(data["data"])
-        album.artistId = data["artistId"]
-        return album
+        return cls(data["data"], artist)
 
     def pickle(self):
         return {
@@ -56,11 +72,18 @@ class Album(object):
         return self.data["name"]
 
     @property
-    def artist(self):
-        if self.artistId is not None:
-            return artist_by_id[self.artistId]
+    def artistId(self):
+        artist = self.artist
+        if artist is not None:
+            return artist.id
         return None
 
+    @property
+    def artistKey(self):
+        if self.artist is not None:
+            return self.artist.key
+        return -1
+
     @property
     def art(self):
         return get_art_for_data(self.data)
@@ -84,17 +107,32 @@ class Album(object):
 # This is a special view of an Album including only the tracks that are in a
 # given library.
 class LibraryAlbum(object):
-    library = None,
-    artist = None,
+    library = None
+    album = None
 
     def __init__(self, library, album):
         self.library = library
         self.album = album
 
+    # Views of the same album in the same library are equal
+    def __eq__(self, other):
+        return (isinstance(other, LibraryAlbum) and other.library.id == self.library.id and
+                other.id == self.id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return __builtin__.hash((self.library.id, self.id))
+
     @property
     def id(self):
         return self.album.id
 
+    @property
+    def key(self):
+        return self.album.key
+
     @property
     def name(self):
         return self.album.name
@@ -122,10 +160,11 @@ class LibraryAlbum(object):
 
 def get_fake_album_for_track(client, track_data):
     # This is a fake track ID, make up an album if necessary
-    albumId = "FB%s" % hash("%s:%s" % (track_data["album"], track_data["albumArtist"]))
+    albumId = get_fake_album_id(track_data["album"], track_data["albumArtist"])
+    album = snapshot().get_item("album", albumId)
 
-    if albumId in album_by_id:
-        return album_by_id[albumId]
+    if album is not None:
+        return album
 
     album_data = {
         "albumId": albumId,
@@ -139,31 +178,26 @@ def get_fake_album_for_track(client, track_data):
     else:
         album_data["albumArtRef"] = None
 
-    album = Album(album_data)
     artist = get_artist_for_track(client, track_data)
-
-    album.artistId = artist.id
-    return album
+    return Album(album_data, artist)
 
 
 def get_real_album_for_track(client, track_data, lookups=True):
     # This is a real track ID, look up the album with the client
     albumId = track_data["albumId"]
+    album = snapshot().get_item("album", albumId)
 
-    if albumId in album_by_id:
-        album = album_by_id[albumId]
-    else:
+    if album is None:
+        # Other threads may see the album as soon as it is created so the artist
+        # must be known first
         album_data = client.get_album_info(albumId, False)
-        album = Album(album_data)
+        artist = get_artist_for_album(client, album_data, track_data, lookups)
+        album = Album(album_data, artist)
 
     if album.name != track_data["album"]:
         logger.warn("Invalid album returned for %s." % track_data["album"])
         return get_fake_album_for_track(client, track_data)
 
-    if album.artistId is None:
-        artist = get_artist_for_album(client, album_data, track_data, lookups)
-        album.artistId = artist.id
-
     return album
 
 
@@ -0,0 +1,195 @@
+# Copyright 2016 Dave Townsend
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urlparse import urlsplit
+
+import requests
+
+logger = logging.getLogger("googlemusicchannel.artcache")
+
+INDEX_NAME = "artcache"
+
+# How often to save the index while images are being added
+INDEX_SAVE_INTERVAL = 30
+
+# How long to wait for an image host before giving up, in seconds
+FETCH_TIMEOUT = 10
+
+# Clients pass the URL to the art route so only images from Google's image
+# hosts are fetched.
+ALLOWED_HOSTS = ["googleusercontent.com", "ggpht.com", "gstatic.com"]
+
+
+def is_allowed(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ["http", "https"] or parts.hostname is None:
+        return False
+
+    return True in map(lambda h: parts.hostname == h or parts.hostname.endswith("." + h),
+                       ALLOWED_HOSTS)
+
+
+# A disk cache of images. Images are stored by a hash of their contents so
+# URLs returning the same image share storage. When the cache grows past its
+# size limit the least recently used URLs are evicted.
+#
+# The storage object must provide exists, load, save, remove, load_object and
+# save_object methods that work with named items.
+class ArtCache(object):
+    storage = None
+    max_bytes = None
+
+    # Maps the URL to a dict containing the digest, size and content type of
+    # its image. Ordered from least to most recently used.
+    index = None
+
+    # The number of URLs using each stored image.
+    digest_refs = None
+    total_bytes = 0
+
+    dirty = False
+    saved = 0
+
+    session = None
+    lock = None
+
+    def __init__(self, storage, max_bytes):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()
+        self.digest_refs = {}
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+
+        if storage.exists(INDEX_NAME):
+            try:
+                for (url, entry) in storage.load_object(INDEX_NAME):
+                    self.add_entry(url, entry)
+            except:
+                logger.exception("Failed to load the art cache index.")
+
+    def item_name(self, digest):
+        return "art-%s" % digest
+
+    def add_entry(self, url, entry):
+        self.index[url] = entry
+        digest = entry["digest"]
+        if digest not in self.digest_refs:
+            self.digest_refs[digest] = 0
+            self.total_bytes += entry["size"]
+        self.digest_refs[digest] += 1
+
+    def remove_entry(self, url):
+        entry = self.index.pop(url)
+        digest = entry["digest"]
+        self.digest_refs[digest] -= 1
+        if self.digest_refs[digest] > 0:
+            return
+
+        del self.digest_refs[digest]
+        self.total_bytes -= entry["size"]
+        try:
+            self.storage.remove(self.item_name(digest))
+        except:
+            logger.exception("Failed to remove cached image %s." % digest)
+
+    def save_index(self, force=False):
+        if not self.dirty or (not force and time.time() - self.saved < INDEX_SAVE_INTERVAL):
+            return
+
+        self.storage.save_object(INDEX_NAME, self.index.items())
+        self.dirty = False
+        self.saved = time.time()
+
+    def fetch(self, url):
+        response = self.session.get(url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        return (response.content, response.headers.get("Content-Type", "image/jpeg"))
+
+    # Returns the stored image or None if it has gone missing
+    def load(self, digest):
+        name = self.item_name(digest)
+        try:
+            if self.storage.exists(name):
+                return self.storage.load(name)
+        except:
+            logger.exception("Failed to load cached image %s." % digest)
+        return None
+
+    # Returns the (data, content type) of the image at the URL, fetching it if
+    # it isn't already cached.
+    def get(self, url):
+        if not is_allowed(url):
+            raise ValueError("Refusing to fetch art from %s." % url)
+
+        with self.lock:
+            entry = self.index.pop(url, None)
+            if entry is not None:
+                self.index[url] = entry
+
+        # Reading from disk is slow so is done without holding the lock
+        if entry is not None:
+            data = self.load(entry["digest"])
+            if data is not None:
+                return (data, entry["type"])
+
+            # The file has gone missing, drop it and fetch it again
+            with self.lock:
+                if self.index.get(url) is entry:
+                    self.remove_entry(url)
+
+        (data, type) = self.fetch(url)
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self.lock:
+            if url not in self.index:
+                name = self.item_name(digest)
+                if digest not in self.digest_refs:
+                    self.storage.save(name, data)
+
+                self.add_entry(url, {
+                    "digest": digest,
+                    "size": len(data),
+                    "type": type
+                })
+
+                while self.total_bytes > self.max_bytes and len(self.index) > 1:
+                    self.remove_entry(next(iter(self.index)))
+
+                self.dirty = True
+                self.save_index()
+
+        return (data, type)
+
+    # Fetches any of the URLs that aren't already cached
+    def prefetch(self, urls):
+        count = 0
+        for url in urls:
+            if url is None or url in self.index or not is_allowed(url):
+                continue
+
+            try:
+                self.get(url)
+                count += 1
+            except:
+                logger.warn("Failed to prefetch %s." % url)
+
+        with self.lock:
+            self.save_index(True)
+        logger.info("Prefetched %d images." % count)
@@ -13,19 +13,33 @@
 # limitations under the License.
 
 import logging
+import __builtin__
 
 from globals import *
 from utils import hash, urlize, get_art_for_data, get_thumb_for_data
 
 logger = logging.getLogger("googlemusicchannel.artist")
 
+# The IDs of the artists made up for uploaded tracks keyed by name. This saves
+# hashing the same names on every update and is persisted along with the
+# catalog.
+fake_artist_ids = {}
+
+
+def get_fake_artist_id(name):
+    if name not in fake_artist_ids:
+        fake_artist_ids[name] = "FA%s" % hash(name)
+    return fake_artist_ids[name]
+
 
 class Artist(object):
     data = None
+    key = None
 
     def __init__(self, data):
         self.data = data
-        artist_by_id[self.id] = self
+        catalog = snapshot()
+        catalog.add_item("artist", self)
 
     @classmethod
     def unpickle(cls, data):
@@ -76,10 +90,25 @@ class LibraryArtist(object):
         self.library = library
         self.artist = artist
 
+    # Views of the same artist in the same library are equal
+    def __eq__(self, other):
+        return (isinstance(other, LibraryArtist) and other.library.id == self.library.id and
+                other.id == self.id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return __builtin__.hash((self.library.id, self.id))
+
     @property
     def id(self):
         return self.artist.id
 
+    @property
+    def key(self):
+        return self.artist.key
+
     @property
     def name(self):
         return self.artist.name
@@ -97,17 +126,20 @@ class LibraryArtist(object):
         return self.library.get_albums_by_artist(self.artist)
 
 
-various_artists = Artist({
+# Albums with no artist are credited to this made up artist. It is created
+# when first needed in each snapshot.
+various_artists = {
     "artistId": "FA" + hash("Various Artists"),
     "name": "Various Artists"
-})
+}
 
 
 # Called when there is no real album for a track
 def get_artist_for_track(client, track_data):
-    artistId = "FA%s" % hash(track_data["albumArtist"])
-    if artistId in artist_by_id:
-        return artist_by_id[artistId]
+    artistId = get_fake_artist_id(track_data["albumArtist"])
+    artist = snapshot().get_item("artist", artistId)
+    if artist is not None:
+        return artist
 
     artist_data = {
         "artistId": artistId,
@@ -126,14 +158,16 @@ def get_artist_for_track(client, track_data):
 
 # Called when we should expect a real artist to exist
 def get_artist_for_album(client, album_data, track_data, lookups=True):
-    artist = None
-
-    if album_data["artistId"][0] in artist_by_id:
-        artist = artist_by_id[album_data["artistId"][0]]
-    elif album_data["artistId"][0] == "":
-        artist = various_artists
-    elif lookups:
-        artist_data = client.get_artist_info(album_data["artistId"][0], False, 0, 0)
+    artistId = album_data["artistId"][0]
+    if artistId == "":
+        artistId = various_artists["artistId"]
+    artist = snapshot().get_item("artist", artistId)
+
+    if artist is None and artistId == various_artists["artistId"]:
+        # This may have been purged if nothing was using it
+        artist = Artist(dict(various_artists))
+    elif artist is None and lookups:
+        artist_data = client.get_artist_info(artistId, False, 0, 0)
         artist = Artist(artist_data)
 
     if artist is None or artist.name != album_data["artist"]:
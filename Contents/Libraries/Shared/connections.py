@@ -0,0 +1,78 @@
+# Copyright 2016 Dave Townsend
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("googlemusicchannel.connections")
+
+# The number of hosts to keep connections open to and the number of idle
+# connections kept for each host.
+POOL_HOSTS = 10
+POOL_SIZE = 10
+
+
+# gmusicapi closes its session whenever a client logs out which would normally
+# close the adapter's connections too. The shared adapter ignores that so the
+# connections remain available to other clients.
+class SharedAdapter(HTTPAdapter):
+    def close(self):
+        pass
+
+    def shutdown(self):
+        HTTPAdapter.close(self)
+
+    # Returns the number of requests made and connections opened by the pools
+    # that are currently alive.
+    def get_stats(self):
+        pools = self.poolmanager.pools
+        with pools.lock:
+            pools = list(pools._container.values())
+
+        requests = sum(map(lambda p: p.num_requests, pools))
+        connections = sum(map(lambda p: p.num_connections, pools))
+        return (requests, connections)
+
+
+adapter = SharedAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+
+
+def mount(rsession):
+    rsession.mount("https://", adapter)
+    rsession.mount("http://", adapter)
+
+
+# Makes a gmusicapi client send everything through the shared connections,
+# including the new sessions it creates after logging out.
+def share_connections(client):
+    session = client.session
+    setup = session._rsession_setup
+
+    def setup_session(rsession):
+        setup(rsession)
+        mount(rsession)
+
+    session._rsession_setup = setup_session
+    mount(session._rsession)
+    return client
+
+
+def log_stats():
+    (requests, connections) = adapter.get_stats()
+    if connections == 0:
+        return
+
+    logger.debug("Made %d requests over %d connections (%.1f requests per connection)." %
+                 (requests, connections, float(requests) / connections))
@@ -19,9 +19,15 @@ from utils import get_art_for_data, get_thumb_for_data
 
 logger = logging.getLogger("googlemusicchannel.genre")
 
+# The most example thumbnails kept for a genre
+MAX_EXAMPLES = 10
+
 
 class FakeGenre(object):
     name = None
+    key = None
+
+    # Album thumbnails from a few of the tracks in the genre
     examples = None
 
     def __init__(self, name):
@@ -33,16 +39,24 @@ class FakeGenre(object):
             "name": self.name
         }
 
+    def add_example(self, track):
+        if len(self.examples) >= MAX_EXAMPLES:
+            return
+
+        thumb = track.album.thumb
+        if thumb is not None and thumb not in self.examples:
+            self.examples.append(thumb)
+
     @property
     def thumb(self):
-        tracks = filter(lambda t: t.album.thumb is not None, self.examples)
-        if len(tracks) == 0:
+        if len(self.examples) == 0:
             return None
-        return tracks[0].album.thumb
+        return self.examples[0]
 
 
 class Genre(object):
     data = None
+    key = None
     children = None
 
     def __init__(self, data):
@@ -54,11 +68,11 @@ class Genre(object):
         if "data" in data:
             genre = cls(data["data"])
             genre.children = map(lambda d: Genre.unpickle(d), data["children"])
-            genre_by_id[genre.id] = genre
+            snapshot().genre_by_id[genre.id] = genre
         else:
             genre = FakeGenre(data["name"])
-        root_genres.append(genre)
-        genre_by_name[genre.name] = genre
+        snapshot().root_genres.append(genre)
+        snapshot().add_genre(genre)
 
         return genre
 
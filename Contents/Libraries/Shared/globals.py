@@ -2,12 +2,338 @@
 # are manually uploaded/created by individuals don't appear here, look in the
 # Library objects for those.
 
+import threading
+import time
+from array import array
+
+from tracktable import TrackTable, KeyMap
+
 base_path = 'https://play.google.com/music/m/'
 
 libraries = {}
-root_genres = []
-genre_by_id = {}
-genre_by_name = {}
-artist_by_id = {}
-album_by_id = {}
-track_by_id = {}
+
+# How often a long running update saves its progress
+CHECKPOINT_INTERVAL = 60
+
+# An update phase that fails isn't tried again for this many seconds so that
+# a failing service doesn't cause a full update on every check
+RETRY_INTERVAL = 60 * 5
+
+# The kinds of catalog object that are reference counted
+COUNTED_KINDS = ["track", "album", "artist"]
+
+# Requests may still be using objects from a snapshot for a while after a
+# newer one is published so the keys of purged objects are only reused after
+# this many seconds. By then the snapshot that last had them has long been
+# replaced.
+KEY_REUSE_DELAY = 60 * 10
+
+
+# A complete view of the catalog and the contents of every library. The
+# published snapshot is never modified by an update, instead the update works
+# on a copy which is then published with a single reference swap. This means
+# request threads always see a consistent view and never have to lock.
+#
+# Request threads do add station tracks, and the albums and artists they need,
+# to the published snapshot. These are logged so that an update running at
+# the same time can build them again in its copy before publishing it.
+class Snapshot(object):
+    generation = 0
+
+    # Genres by the service's ID and by name
+    root_genres = None
+    genre_by_id = None
+    genre_by_name = None
+
+    # Every genre, artist, album and track is given a dense integer key when it
+    # is created. Indexes and the track table refer to objects by key, IDs are
+    # only used to talk to the service, in URLs and when saving. Tracks and
+    # albums hold their album and artist directly so they stay usable by
+    # requests after a newer snapshot is published. These map IDs to keys and
+    # back, genres by name. A track's key is its row in the track table.
+    keys = None
+
+    # The objects indexed by key, None for unused keys
+    genres = None
+    artists = None
+    albums = None
+    tracks = None
+
+    # Every artist, album and track keyed by ID as (kind, key) pairs
+    item_by_id = None
+
+    # The numeric fields of every track
+    track_table = None
+
+    # The per-library contents keyed by library ID
+    library_contents = None
+
+    # Reference counts for catalog objects indexed by key. Tracks are
+    # referenced by libraries and playlists, albums by referenced tracks and
+    # artists by referenced albums.
+    track_refs = None
+    album_refs = None
+    artist_refs = None
+
+    # Objects that may have no references and so can be purged. These are
+    # (kind, key) pairs.
+    unreferenced = None
+
+    # Libraries update in parallel so reference counting must be serialized
+    lock = None
+
+    # Called with the snapshot to save the progress of an update
+    checkpoint_handler = None
+    checkpointed = 0
+
+    # The (kind, item) pairs added while this snapshot was published, and the
+    # length of that log in the snapshot this one was copied from when it was
+    # copied.
+    added = None
+    copied_added = 0
+
+    def __init__(self):
+        self.root_genres = []
+        self.genre_by_id = {}
+        self.genre_by_name = {}
+        self.track_table = TrackTable(reuse_delay=KEY_REUSE_DELAY)
+        self.keys = {
+            "genre": KeyMap(),
+            "artist": KeyMap(KEY_REUSE_DELAY),
+            "album": KeyMap(KEY_REUSE_DELAY),
+            "track": self.track_table.rows,
+        }
+        self.genres = []
+        self.artists = []
+        self.albums = []
+        self.tracks = []
+        self.item_by_id = {}
+        self.library_contents = {}
+        self.track_refs = array("i")
+        self.album_refs = array("i")
+        self.artist_refs = array("i")
+        self.unreferenced = set()
+        self.added = []
+        self.lock = threading.RLock()
+
+    # Request threads may be adding to the published snapshot so it is copied
+    # under the lock
+    def copy(self):
+        with self.lock:
+            return self._copy()
+
+    def _copy(self):
+        snapshot = Snapshot()
+        snapshot.copied_added = len(self.added)
+        snapshot.generation = self.generation + 1
+        snapshot.root_genres = list(self.root_genres)
+        snapshot.genre_by_id = dict(self.genre_by_id)
+        snapshot.genre_by_name = dict(self.genre_by_name)
+        snapshot.track_table = self.track_table.copy()
+        snapshot.keys = {
+            "genre": self.keys["genre"].copy(),
+            "artist": self.keys["artist"].copy(),
+            "album": self.keys["album"].copy(),
+            "track": snapshot.track_table.rows,
+        }
+        snapshot.genres = list(self.genres)
+        snapshot.artists = list(self.artists)
+        snapshot.albums = list(self.albums)
+        snapshot.tracks = list(self.tracks)
+        snapshot.item_by_id = dict(self.item_by_id)
+        snapshot.library_contents = dict([(id, c.copy()) for (id, c) in
+                                          self.library_contents.items()])
+        snapshot.track_refs = self.track_refs[:]
+        snapshot.album_refs = self.album_refs[:]
+        snapshot.artist_refs = self.artist_refs[:]
+        snapshot.unreferenced = set(self.unreferenced)
+        return snapshot
+
+    # Called by the artist, album and track constructors. Gives the item its
+    # key, the item starts with no references.
+    def add_item(self, kind, item):
+        with self.lock:
+            if kind == "track":
+                key = self.track_table.add(item.id, item.get_columns())
+            else:
+                key = self.keys[kind].add(item.id)
+            item.key = key
+
+            items = getattr(self, "%ss" % kind)
+            if key == len(items):
+                items.append(item)
+                getattr(self, "%s_refs" % kind).append(0)
+            else:
+                items[key] = item
+            self.item_by_id[item.id] = (kind, key)
+            self.unreferenced.add((kind, key))
+
+            if self is _published:
+                self.added.append((kind, item))
+
+    # Genre keys are never freed so tracks keep pointing at the right genre
+    # even if it disappears from the service for a while.
+    def add_genre(self, genre):
+        with self.lock:
+            key = self.keys["genre"].add(genre.name)
+            genre.key = key
+
+            if key == len(self.genres):
+                self.genres.append(genre)
+            else:
+                self.genres[key] = genre
+            self.genre_by_name[genre.name] = genre
+
+    def remove_genre(self, name):
+        with self.lock:
+            genre = self.genre_by_name.pop(name)
+            self.genres[genre.key] = None
+
+    # Returns the artist, album or track with the given ID or None
+    def get_item(self, kind, id):
+        key = self.keys[kind].keys.get(id)
+        if key is None:
+            return None
+        return getattr(self, "%ss" % kind)[key]
+
+    # Returns every artist, album or track in the catalog
+    def get_items(self, kind):
+        return filter(lambda i: i is not None, getattr(self, "%ss" % kind))
+
+    # Finds an artist, album or track by ID. Returns a (kind, object) pair or
+    # None.
+    def find_item(self, id):
+        found = self.item_by_id.get(id)
+        if found is None:
+            return None
+
+        (kind, key) = found
+        return (kind, getattr(self, "%ss" % kind)[key])
+
+    def _add_reference(self, refs, key):
+        count = refs[key]
+        refs[key] = count + 1
+        return count == 0
+
+    def _remove_reference(self, kind, refs, key):
+        count = refs[key] - 1
+        refs[key] = count
+        if count > 0:
+            return False
+        self.unreferenced.add((kind, key))
+        return True
+
+    def add_reference(self, track_key):
+        with self.lock:
+            self._add_track_reference(track_key)
+
+    def remove_reference(self, track_key):
+        with self.lock:
+            self._remove_track_reference(track_key)
+
+    def _add_track_reference(self, track_key):
+        if not self._add_reference(self.track_refs, track_key):
+            return
+
+        album_key = self.tracks[track_key].albumKey
+        if not self._add_reference(self.album_refs, album_key):
+            return
+
+        artist_key = self.albums[album_key].artistKey
+        if artist_key >= 0:
+            self._add_reference(self.artist_refs, artist_key)
+
+    def _remove_track_reference(self, track_key):
+        if not self._remove_reference("track", self.track_refs, track_key):
+            return
+
+        album_key = self.tracks[track_key].albumKey
+        if not self._remove_reference("album", self.album_refs, album_key):
+            return
+
+        artist_key = self.albums[album_key].artistKey
+        if artist_key >= 0:
+            self._remove_reference("artist", self.artist_refs, artist_key)
+
+    # Called regularly by long running updates. Saves the snapshot if it
+    # hasn't been saved recently so an interrupted update can carry on from
+    # roughly where it stopped.
+    def checkpoint(self):
+        if self.checkpoint_handler is None:
+            return
+
+        with self.lock:
+            now = time.time()
+            if self.checkpointed == 0:
+                self.checkpointed = now
+            if now - self.checkpointed < CHECKPOINT_INTERVAL:
+                return
+            self.checkpointed = now
+
+        self.checkpoint_handler(self)
+
+    # Frees any objects that have lost their last reference or were created and
+    # never referenced, their keys are reused by new objects after
+    # KEY_REUSE_DELAY. Returns the number of objects freed.
+    def collect(self):
+        with self.lock:
+            count = 0
+            for (kind, key) in self.unreferenced:
+                items = getattr(self, "%ss" % kind)
+                item = items[key]
+                if item is None or getattr(self, "%s_refs" % kind)[key] > 0:
+                    continue
+
+                items[key] = None
+                if self.item_by_id.get(item.id) == (kind, key):
+                    del self.item_by_id[item.id]
+                if kind == "track":
+                    self.track_table.remove(item.id)
+                    # The key will be reused by another track
+                    for contents in self.library_contents.values():
+                        contents.track_records.pop(key, None)
+                else:
+                    self.keys[kind].remove(item.id)
+                count += 1
+
+            for kind in COUNTED_KINDS:
+                self.keys[kind].release()
+
+            self.unreferenced = set()
+            return count
+
+
+_published = Snapshot()
+_local = threading.local()
+
+
+# Returns the snapshot the current thread should use. Threads running an update
+# see the snapshot being built, everything else sees the published snapshot.
+def snapshot():
+    staging = getattr(_local, "staging", None)
+    if staging is not None:
+        return staging
+    return _published
+
+
+def published():
+    return _published
+
+
+# Makes the current thread read from and write to the given snapshot. Passing
+# None returns the thread to the published snapshot.
+def stage(snapshot):
+    _local.staging = snapshot
+
+
+# Starts building a new snapshot from the published one on the current thread.
+def begin_update():
+    staging = _published.copy()
+    stage(staging)
+    return staging
+
+
+def publish(snapshot):
+    global _published
+    _published = snapshot
+    stage(None)
@@ -12,18 +12,222 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import threading
+import bisect
+from array import array
+import time
 
 from globals import *
-from track import get_track_for_data
+from track import get_track_for_data, get_library_columns
 from album import LibraryAlbum
-from station import Station
-from utils import get_art_for_data, get_thumb_for_data
+from artist import LibraryArtist
+from station import Station, StationQueue, PREFETCH_STATIONS
+from throttle import ThrottledClient, CircuitOpen, set_background, is_rejected
+from connections import share_connections
+from tracktable import TrackTable, LIBRARY_COLUMNS
+from utils import hash, encrypt, decrypt, get_art_for_data, get_thumb_for_data
 
 from gmusicapi import Mobileclient
 
 logger = logging.getLogger("googlemusicchannel.library")
 
+# The library update is split into phases that each run on their own schedule.
+# The track listing is expensive and rarely changes so runs infrequently while
+# playlists and stations are cheap and change often. Intervals are in seconds.
+UPDATE_PHASES = [
+    ("tracks", 60 * 60),
+    ("playlists", 60 * 10),
+    ("stations", 60 * 10),
+]
+
+# Situations are only loaded when someone looks at them and are then kept for
+# this many seconds.
+SITUATION_TTL = 60 * 30
+
+# Maps the seed types used when creating stations to the seed's field in the
+# station data.
+SEED_FIELDS = [
+    ("artist", "artistId"),
+    ("album", "albumId"),
+    ("track", "trackId"),
+    ("genre", "genreId"),
+    ("curated_station", "curatedStationId"),
+]
+
+
+# Converts the keyword argument for create_station, e.g. artist_id, into a
+# (seed type, seed ID) pair.
+def get_seed(kwargs):
+    (arg, seedId) = kwargs.items()[0]
+    return (arg[:-len("_id")], seedId)
+
+
+# The contents of a library. These live in the snapshot so that they are
+# published along with the catalog objects that they reference.
+class LibraryContents(object):
+    # These are the catalog keys of all the tracks in the user's library keyed
+    # by the track's library ID, not the store ID
+    track_by_id = None
+
+    playlist_by_id = None
+
+    station_by_id = None
+
+    # Records for listing the tracks in the library and its playlists keyed
+    # by track key as (track, record) pairs. See Track.get_record.
+    track_records = None
+
+    # The fields of the library's tracks that depend on the account, with rows
+    # keyed by library ID. See get_library_columns.
+    track_table = None
+
+    # Built when first needed and discarded whenever the tracks change
+    index = None
+
+    def __init__(self):
+        self.track_by_id = {}
+        self.playlist_by_id = {}
+        self.station_by_id = {}
+        self.track_records = {}
+        self.track_table = TrackTable(LIBRARY_COLUMNS)
+
+    def copy(self):
+        contents = LibraryContents()
+        contents.track_by_id = dict(self.track_by_id)
+        contents.playlist_by_id = dict(self.playlist_by_id)
+        contents.station_by_id = dict(self.station_by_id)
+        contents.track_records = dict(self.track_records)
+        contents.track_table = self.track_table.copy()
+        return contents
+
+    # Every track key that these contents hold a reference to
+    def referenced_tracks(self):
+        keys = self.track_by_id.values()
+        for playlist in self.playlist_by_id.values():
+            keys.extend(playlist.track_keys)
+        return keys
+
+    # values are the track's fields in this library, see get_library_columns
+    def set_track(self, lid, trackKey, values):
+        self.track_table.add(lid, dict(values, key=trackKey))
+
+        previous = self.track_by_id.get(lid)
+        if previous == trackKey:
+            return
+
+        snapshot().add_reference(trackKey)
+        self.track_by_id[lid] = trackKey
+        self.index = None
+        if previous is not None:
+            snapshot().remove_reference(previous)
+
+    def remove_track(self, lid):
+        trackKey = self.track_by_id.pop(lid)
+        self.track_table.remove(lid)
+        self.index = None
+        self.track_records.pop(trackKey, None)
+        snapshot().remove_reference(trackKey)
+
+    def set_playlist(self, playlist):
+        previous = self.playlist_by_id.get(playlist.id)
+        self.playlist_by_id[playlist.id] = playlist
+        if previous is not None:
+            previous.release()
+
+    def remove_playlist(self, playlistId):
+        self.playlist_by_id.pop(playlistId).release()
+
+    def release(self):
+        catalog = snapshot()
+        for trackKey in self.referenced_tracks():
+            catalog.remove_reference(trackKey)
+
+
+# The albums and artists in a library and which tracks and albums belong to
+# them. There is a single view object for each album and artist.
+#
+# Queries on the library use the snapshot the index was built from so that a
+# request gets results from one snapshot even if another is published while
+# it runs.
+class LibraryIndex(object):
+    catalog = None
+    tracks = None
+
+    # The library's rows in the catalog's track table
+    rows = None
+
+    # The library's own track table and its rows
+    library_table = None
+    library_rows = None
+
+    # The rest are keyed by album key and artist key. Album tracks are kept in
+    # order as they are added, sort_keys holds their sort keys.
+    album_views = None
+    artist_views = None
+    tracks_by_album = None
+    sort_keys = None
+    albums_by_artist = None
+
+    def __init__(self, library, contents, catalog):
+        self.catalog = catalog
+        tracks = catalog.tracks
+        self.rows = array("i", set(contents.track_by_id.values()))
+        self.tracks = map(lambda key: tracks[key], self.rows)
+        self.library_table = contents.track_table
+        self.library_rows = array("i", contents.track_table.rows.keys.values())
+        self.album_views = {}
+        self.artist_views = {}
+        self.tracks_by_album = {}
+        self.sort_keys = {}
+        self.albums_by_artist = {}
+
+        for track in self.tracks:
+            album = track.album
+            if track.albumKey not in self.album_views:
+                view = LibraryAlbum(library, album)
+                self.album_views[track.albumKey] = view
+                self.tracks_by_album[track.albumKey] = []
+                self.sort_keys[track.albumKey] = []
+
+                artistKey = album.artistKey
+                if artistKey >= 0:
+                    if artistKey not in self.artist_views:
+                        self.artist_views[artistKey] = LibraryArtist(library, album.artist)
+                        self.albums_by_artist[artistKey] = []
+                    self.albums_by_artist[artistKey].append(view)
+
+            keys = self.sort_keys[track.albumKey]
+            position = bisect.bisect_right(keys, track.sort_key)
+            keys.insert(position, track.sort_key)
+            self.tracks_by_album[track.albumKey].insert(position, track)
+
+    # Track keys are also their rows in the track table
+    def get_tracks_for_rows(self, rows):
+        tracks = self.catalog.tracks
+        return map(lambda key: tracks[key], rows)
+
+
+# Everything login sets on the client, including the subscription status
+# which decides whether requests are made as a subscriber
+def get_session_tokens(client):
+    session = client.client.session
+    return (session._master_token, session._authtoken, client.client.android_id,
+            session._locale, session._is_subscribed)
+
+
+# Makes a client use a previously saved session rather than logging in
+def restore_session(client, tokens):
+    (master_token, auth_token, android_id, locale, is_subscribed) = tokens
+    session = client.client.session
+    session._master_token = master_token
+    session._authtoken = auth_token
+    session._locale = locale
+    session._is_subscribed = is_subscribed
+    session.is_authenticated = True
+    client.client.android_id = android_id
+
 
 # We need at least one Library in order to have a valid client
 class Library(object):
@@ -34,75 +238,205 @@ class Library(object):
 
     client = None
 
+    # Saved sessions for the library and stream clients keyed by "library" or
+    # "stream", see get_session_tokens, and the device ID used for streaming.
+    # These survive restarts so logging in can be skipped.
+    tokens = None
+    device_id = None
+    session_changed = False
+
     situations = None
+    situation_lock = None
 
-    # These are all the tracks in the user's library. The key is the track's
-    # library ID, not the store ID
-    track_by_id = None
+    # The time that each update phase last completed successfully and the
+    # time that each phase last failed, see RETRY_INTERVAL
+    last_update = None
+    last_failure = None
 
-    playlist_by_id = None
+    # Buffers of upcoming tracks for stations keyed by station ID
+    station_queues = None
 
-    station_by_id = None
+    # The IDs of stations already created on the server keyed by the
+    # (seed type, seed ID) that they were created from.
+    station_seeds = None
 
-    def __init__(self, username, password):
-        self.id = 0
+    def __init__(self, id, username, password):
+        self.id = id
         libraries[self.id] = self
 
         self.username = username
         self.password = password
+        self.station_queues = {}
+        self.station_seeds = {}
+        self.tokens = {}
+        self.last_failure = {}
+        self.situation_lock = threading.Lock()
 
         self.clear()
 
-        self.client = Mobileclient(False, False, True)
+        self.client = ThrottledClient(share_connections(Mobileclient(False, False, True)),
+                                      self.reauthenticate)
+
+    @property
+    def contents(self):
+        return self.get_contents(snapshot())
+
+    def get_contents(self, catalog):
+        contents = catalog.library_contents
+        if self.id not in contents:
+            return contents.setdefault(self.id, LibraryContents())
+        return contents[self.id]
+
+    @property
+    def track_by_id(self):
+        return self.contents.track_by_id
+
+    @property
+    def playlist_by_id(self):
+        return self.contents.playlist_by_id
+
+    @property
+    def station_by_id(self):
+        return self.contents.station_by_id
 
     # Because of threading shenanigans we have to manually pickle classes
     def pickle(self):
+        tracks = snapshot().tracks
+        table = self.contents.track_table
+        fields = ["added", "modified", "plays"]
         return {
+            "id": self.id,
             "username": self.username,
             "password": self.password,
-            "tracks": self.track_by_id,
+            "tracks": dict([(lid, tracks[key].id) for (lid, key) in self.track_by_id.items()]),
+            "track_columns": dict([(lid, table.get(lid, fields)) for lid in self.track_by_id]),
             "playlists": map(lambda p: p.pickle(), self.playlist_by_id.values()),
-            "stations": map(lambda s: s.pickle(), self.station_by_id.values())
+            "stations": map(lambda s: s.pickle(), self.station_by_id.values()),
+            "last_update": dict(self.last_update),
+            "station_seeds": dict(self.station_seeds)
         }
 
     @classmethod
-    def unpickle(cls, data):
+    def unpickle(cls, data, track_rows):
         try:
-            library = cls(data["username"], data["password"])
+            library = cls(data.get("id", 0), data["username"], data["password"])
 
             library.clear()
 
-            library.track_by_id = data["tracks"]
+            contents = library.contents
+            columns = data.get("track_columns", {})
+            for (lid, trackId) in data["tracks"].items():
+                track = snapshot().get_item("track", trackId)
+                if track is not None:
+                    # Saved by an older version, use the catalog's data
+                    values = columns.get(lid) or get_library_columns(track.data)
+                    contents.set_track(lid, track.key, values)
+                    library.add_track_record(track)
             for playlist_data in data["playlists"]:
-                Playlist.unpickle(library, playlist_data)
+                Playlist.unpickle(library, playlist_data, track_rows)
 
             for station_data in data["stations"]:
                 Station.unpickle(library, station_data)
+
+            library.last_update = data.get("last_update", {})
+            library.station_seeds = data.get("station_seeds", {})
+            return library
         except:
             logger.exception("Failed to load data.")
             return None
 
-    def get_library_client(self):
-        if self.client.is_authenticated():
-            return self.client
+    # The master token gives full access to the account so the tokens are
+    # saved encrypted with the password, which Plex keeps as a secure pref.
+    def pickle_session(self):
+        self.session_changed = False
+        return {
+            "id": self.id,
+            "username": self.username,
+            "tokens": encrypt(self.password, json.dumps(self.tokens)),
+            "device_id": self.device_id
+        }
 
-        logger.info("Logging in '%s' with MAC address." % (self.username))
-        self.client.login(self.username, self.password, Mobileclient.FROM_MAC_ADDRESS)
+    def unpickle_session(self, data):
+        if data["username"] != self.username:
+            return
 
-        if not self.client.is_authenticated():
-            raise Exception("Client couldn't log in.")
+        self.device_id = data["device_id"]
 
-        return self.client
+        tokens = None
+        if isinstance(data["tokens"], basestring):
+            tokens = decrypt(self.password, data["tokens"])
+        if tokens is None:
+            # Saved in the clear by an older version or with another password
+            self.session_changed = True
+            return
 
-    def get_stream_client(self):
-        device_id = self.get_device_id()
-        client = Mobileclient(False, False, True)
-        logger.info("Logging in '%s' with device id '%s'." % (self.username, device_id))
-        client.login(self.username, self.password, device_id)
+        self.tokens = json.loads(tokens)
+
+    def login_client(self, client, kind):
+        if kind in self.tokens:
+            restore_session(client, self.tokens[kind])
+            return
+
+        if kind == "library":
+            logger.info("Logging in '%s' with MAC address." % (self.username))
+            android_id = Mobileclient.FROM_MAC_ADDRESS
+        else:
+            android_id = self.get_device_id()
+            logger.info("Logging in '%s' with device id '%s'." % (self.username, android_id))
+
+        client.login(self.username, self.password, android_id)
 
         if not client.is_authenticated():
             raise Exception("Client couldn't log in.")
 
+        self.tokens[kind] = get_session_tokens(client)
+        self.session_changed = True
+
+    # Saved sessions are only checked when the server rejects them. Rejected
+    # stream sessions may be due to the device being deregistered so the
+    # device ID is looked up again too.
+    def reauthenticate(self, client):
+        kind = "library" if client is self.client else "stream"
+        logger.info("Server rejected the %s session for '%s'." % (kind, self.username))
+
+        self.tokens.pop(kind, None)
+        if kind == "stream":
+            self.device_id = None
+        self.session_changed = True
+
+        client.logout()
+        self.login_client(client, kind)
+
+    # Records are built as tracks are added so that listing them doesn't need
+    # to look anything up
+    def add_track_record(self, track):
+        self.contents.track_records[track.key] = (track, track.get_record(self))
+
+    # Returns the stored record for a track or None if the track isn't in the
+    # library or its playlists. Keys are reused so the record is only used if
+    # it is for this track.
+    def find_track_record(self, track):
+        entry = self.contents.track_records.get(track.key)
+        if entry is None or entry[0] is not track:
+            return None
+        return entry[1]
+
+    def get_track_record(self, track):
+        record = self.find_track_record(track)
+        if record is None:
+            record = track.get_record(self)
+        return record
+
+    def get_library_client(self):
+        if not self.client.is_authenticated():
+            self.login_client(self.client, "library")
+
+        return self.client
+
+    def get_stream_client(self):
+        client = ThrottledClient(share_connections(Mobileclient(False, False, True)),
+                                 self.reauthenticate)
+        self.login_client(client, "stream")
         return client
 
     def logout(self):
@@ -110,6 +444,12 @@ class Library(object):
             self.client.logout()
 
     def get_device_id(self):
+        if self.device_id is None:
+            self.device_id = self.find_device_id()
+            self.session_changed = True
+        return self.device_id
+
+    def find_device_id(self):
         devices = self.get_library_client().get_registered_devices()
         for device in devices:
             if device["type"] == "ANDROID":
@@ -119,132 +459,264 @@ class Library(object):
 
         raise Exception("Unable to find a valid device ID")
 
+    # May be called on the published snapshot when the prefs change
     def clear(self):
-        self.track_by_id = {}
-        self.playlist_by_id = {}
-        self.station_by_id = {}
-
-    def update(self):
-        logger.info("Starting library update.")
+        catalog = snapshot()
+        with catalog.lock:
+            contents = catalog.library_contents
+            if self.id in contents:
+                contents[self.id].release()
+            contents[self.id] = LibraryContents()
+        self.last_update = {}
+
+    def is_due(self, phase, interval, now):
+        if now - self.last_failure.get(phase, 0) < RETRY_INTERVAL:
+            return False
+        return now - self.last_update.get(phase, 0) >= interval
+
+    def is_update_due(self, now):
+        return True in [self.is_due(p, i, now) for (p, i) in UPDATE_PHASES]
+
+    # Runs any update phases that are due. Returns True if the library changed.
+    def update(self, force=False):
+        now = time.time()
+        due = [(p, i) for (p, i) in UPDATE_PHASES if force or self.is_due(p, i, now)]
+        if len(due) == 0:
+            return False
+
+        logger.info("Starting library update (%s)." % ", ".join([p for (p, i) in due]))
 
         try:
             client = self.get_library_client()
         except:
             logger.exception("Failed to log in to library.")
+            for (phase, interval) in due:
+                self.last_failure[phase] = now
             self.clear()
-            return
-
-        try:
-            data = client.get_all_songs(False, False)
-            logger.info("Found %d tracks in the cloud library." % (len(data)))
-
-            track_ids = set(map(lambda s: s["id"], data))
-
-            currentset = set(self.track_by_id.keys())
-
-            deletedset = currentset - track_ids
-            addedset = track_ids - currentset
-            modifiedset = currentset & track_ids
-
-            logger.info("Adding %d new tracks and updating %d existing tracks." %
-                        (len(addedset), len(modifiedset)))
-
-            def add_track(track_data):
-                lid = track_data["id"]
-
+            return True
+
+        updated = False
+        for (phase, interval) in due:
+            previous = self.contents.copy()
+            try:
+                getattr(self, "update_%s" % phase)(client)
+                self.last_update[phase] = time.time()
+                self.last_failure.pop(phase, None)
+                updated = True
+            except:
+                logger.exception("Failed to update library %s." % phase)
+                self.last_failure[phase] = time.time()
+                # Don't publish the partial results of the failed phase
+                for trackKey in previous.referenced_tracks():
+                    snapshot().add_reference(trackKey)
+                self.contents.release()
+                snapshot().library_contents[self.id] = previous
+
+        return updated
+
+    # The listing is processed a page at a time as it arrives so only the
+    # current page of track data is held in memory.
+    def update_tracks(self, client):
+        currentset = set(self.track_by_id.keys())
+        seenset = set()
+        added = 0
+
+        # A track that fails is skipped, it will be tried again next update
+        def add_track(track_data):
+            lid = track_data["id"]
+
+            try:
                 track = get_track_for_data(self, track_data)
-                self.track_by_id[lid] = track.id
-
-            for track_data in filter(lambda d: "nid" in d, data):
+            except CircuitOpen:
+                raise
+            except:
+                logger.exception("Failed to add track %s." % lid)
+                return
+
+            # Existing tracks are reused so the listing's fields for this
+            # account are kept in the library
+            self.contents.set_track(lid, track.key, get_library_columns(track_data))
+            self.add_track_record(track)
+            snapshot().checkpoint()
+
+        for page in client.get_all_songs(True, False):
+            for track_data in page:
+                seenset.add(track_data["id"])
+                if track_data["id"] not in currentset:
+                    added += 1
+
+            for track_data in filter(lambda d: "nid" in d, page):
                 add_track(track_data)
 
-            for track_data in filter(lambda d: "nid" not in d, data):
+            for track_data in filter(lambda d: "nid" not in d, page):
                 add_track(track_data)
 
-            logger.info("Removing %d old tracks." % (len(deletedset)))
+        logger.info("Found %d tracks in the cloud library, %d of them new." %
+                    (len(seenset), added))
 
-            for id in deletedset:
-                if id in self.track_by_id:
-                    del self.track_by_id[id]
+        deletedset = currentset - seenset
+        logger.info("Removing %d old tracks." % (len(deletedset)))
 
-            logger.info("Track update complete, library has %d tracks." % (len(self.track_by_id)))
+        for id in deletedset:
+            if id in self.track_by_id:
+                self.contents.remove_track(id)
 
-            seenlists = set()
+        logger.info("Track update complete, library has %d tracks." % (len(self.track_by_id)))
 
-            def add_playlist(playlist_data, entries):
-                playlist = Playlist(self, playlist_data)
-                seenlists.add(playlist.id)
+    def update_playlists(self, client):
+        catalog = snapshot()
+        seenlists = set()
 
-                for entry in entries:
-                    trackId = entry["trackId"]
-                    if trackId in self.track_by_id:
-                        trackId = self.track_by_id[trackId]
-                    if trackId in track_by_id:
-                        playlist.track_ids.append(track_by_id[trackId].id)
-                        continue
-                    track_data = client.get_track_info(trackId)
-                    playlist.track_ids.append(get_track_for_data(self, track_data).id)
+        def add_playlist(playlist_data, entries):
+            playlist = Playlist(self, playlist_data)
+            seenlists.add(playlist.id)
+
+            for entry in entries:
+                trackId = entry["trackId"]
+                if trackId in self.track_by_id:
+                    playlist.add_track(self.track_by_id[trackId])
+                    continue
 
-            playlists = client.get_all_user_playlist_contents()
-            for playlist in playlists:
-                if playlist["deleted"]:
+                track = catalog.get_item("track", trackId)
+                if track is not None:
+                    playlist.add_track(track.key)
                     continue
-                add_playlist(playlist, playlist["tracks"])
 
-            all_playlists = client.get_all_playlists(False, False)
-            for playlist in all_playlists:
-                if playlist.get("type") != "USER_GENERATED":
+                try:
+                    track_data = client.get_track_info(trackId)
+                    playlist.add_track(get_track_for_data(self, track_data).key)
+                except CircuitOpen:
+                    raise
+                except:
+                    logger.exception("Failed to add track %s to playlist." % trackId)
+
+            snapshot().checkpoint()
+
+        playlists = client.get_all_user_playlist_contents()
+        for playlist in playlists:
+            if playlist["deleted"]:
+                continue
+            add_playlist(playlist, playlist["tracks"])
+
+        all_playlists = client.get_all_playlists(False, False)
+        for playlist in all_playlists:
+            if playlist.get("type") != "USER_GENERATED":
+                try:
                     entries = client.get_shared_playlist_contents(playlist["shareToken"])
-                    add_playlist(playlist, entries)
+                except CircuitOpen:
+                    raise
+                except:
+                    # Keep whatever we had for the playlist before
+                    logger.exception("Failed to load shared playlist %s." % playlist["id"])
+                    seenlists.add(playlist["id"])
+                    continue
+                add_playlist(playlist, entries)
 
-            gonelists = set(self.playlist_by_id.keys()) - seenlists
-            for listid in gonelists:
-                del self.playlist_by_id[listid]
+        gonelists = set(self.playlist_by_id.keys()) - seenlists
+        for listid in gonelists:
+            self.contents.remove_playlist(listid)
 
-            logger.info("Library has %d playlists." % (len(self.playlist_by_id)))
+        logger.info("Library has %d playlists." % (len(self.playlist_by_id)))
 
-            current_stations = set()
-            stations = client.get_all_stations()
-            for station_data in stations:
-                if not station_data["inLibrary"]:
-                    continue
-                station = Station(self, station_data)
-                current_stations.add(station.id)
+    def update_stations(self, client):
+        current_stations = set()
+        stations = client.get_all_stations()
+        for station_data in stations:
+            # Remember every station so we don't create duplicates later
+            seed = station_data.get("seed", {})
+            for (type, field) in SEED_FIELDS:
+                if field in seed:
+                    self.station_seeds[(type, seed[field])] = station_data["id"]
 
-            removed = set(self.station_by_id.keys()) - current_stations
-            for rem in removed:
-                del self.station_by_id[rem]
+            if not station_data["inLibrary"]:
+                continue
+            station = Station(self, station_data)
+            current_stations.add(station.id)
 
-            logger.info("Library has %d stations." % (len(self.station_by_id)))
+        removed = set(self.station_by_id.keys()) - current_stations
+        for rem in removed:
+            del self.station_by_id[rem]
 
-            self.situations = self.load_listen_situations()
-        except:
-            logger.exception("Failed to update library.")
+        logger.info("Library has %d stations." % (len(self.station_by_id)))
+
+    @property
+    def index(self):
+        catalog = snapshot()
+        contents = self.get_contents(catalog)
+        index = contents.index
+        if index is None:
+            index = LibraryIndex(self, contents, catalog)
+            contents.index = index
+        return index
 
     def get_artists(self):
-        return set(map(lambda t: t.artist, self.get_tracks()))
+        return self.index.artist_views.values()
 
     def get_albums(self):
-        return map(lambda a: LibraryAlbum(self, a), set(map(lambda t: t.album, self.get_tracks())))
+        return self.index.album_views.values()
 
     def get_albums_by_artist(self, artist):
-        return set(map(lambda t: LibraryAlbum(self, t.album),
-                       filter(lambda t: t.artist == artist, self.get_tracks())))
+        return list(self.index.albums_by_artist.get(artist.key, []))
+
+    # Returns the view of the artist in this library
+    def get_artist_view(self, artist):
+        view = self.index.artist_views.get(artist.key)
+        if view is None:
+            view = LibraryArtist(self, artist)
+        return view
+
+    def get_album_view(self, album):
+        view = self.index.album_views.get(album.key)
+        if view is None:
+            view = LibraryAlbum(self, album)
+        return view
 
     def get_tracks(self):
-        return map(lambda id: track_by_id[id], self.track_by_id.values())
+        return list(self.index.tracks)
 
     def get_tracks_in_album(self, album):
-        return sorted(filter(lambda t: t.album == album, self.get_tracks()))
+        return list(self.index.tracks_by_album.get(album.key, []))
 
     def get_tracks_in_genre(self, genre):
-        return filter(lambda t: t.genre == genre, self.get_tracks())
-
-    def get_genres(self):
-        return set(map(lambda t: t.genre, self.get_tracks()))
+        index = self.index
+        table = index.catalog.track_table
+        return index.get_tracks_for_rows(table.select("genre", genre.key, index.rows))
+
+    # Returns the genres with tracks in the library. Pass the result of
+    # get_genre_counts to get genres from the same snapshot as the counts.
+    def get_genres(self, counts=None):
+        if counts is None:
+            counts = self.get_genre_counts()
+        genres = snapshot().genres
+        return filter(lambda g: g is not None, map(lambda key: genres[key], counts.keys()))
+
+    # Returns the number of tracks in each genre keyed by genre key
+    def get_genre_counts(self):
+        index = self.index
+        return index.catalog.track_table.count_by("genre", index.rows)
+
+    # Returns the total duration of each artist's tracks keyed by artist key
+    def get_artist_durations(self):
+        index = self.index
+        return index.catalog.track_table.sum_by("duration", "artist", index.rows)
+
+    # Added times differ between accounts so come from the library's table. A
+    # track may be in the library more than once but is only listed once.
+    def get_recent_tracks(self, count):
+        index = self.index
+        table = index.library_table
+        keys = table.get_values("key", table.sort("added", index.library_rows, True))
+        recent = []
+        for key in keys:
+            if key not in recent:
+                recent.append(key)
+                if len(recent) == count:
+                    break
+        return index.get_tracks_for_rows(recent)
 
     def get_track(self, trackId):
-        return self.track_by_id[trackId]
+        catalog = snapshot()
+        return catalog.tracks[self.get_contents(catalog).track_by_id[trackId]]
 
     def get_playlist(self, playlistId):
         return self.playlist_by_id[playlistId]
@@ -258,19 +730,80 @@ class Library(object):
     def get_station(self, id):
         return self.station_by_id[id]
 
+    # Takes a single seed keyword argument as accepted by create_station
     def get_station_id(self, name, **kwargs):
-        return self.get_library_client().create_station(name, **kwargs)
+        seed = get_seed(kwargs)
+        if seed in self.station_seeds:
+            return self.station_seeds[seed]
+
+        stationId = self.get_library_client().create_station(name, **kwargs)
+        self.station_seeds[seed] = stationId
+        return stationId
+
+    # Returns the station ID and the first tracks for a seeded station. A
+    # previously created station is reused unless the server rejects it.
+    def get_seed_station_tracks(self, name, num_tracks, **kwargs):
+        seed = get_seed(kwargs)
+        cached = seed in self.station_seeds
+
+        stationId = self.get_station_id(name, **kwargs)
+        if not cached:
+            return (stationId, self.get_station_tracks(stationId, num_tracks))
+
+        try:
+            tracks = self.get_station_tracks(stationId, num_tracks)
+            if len(tracks) > 0:
+                return (stationId, tracks)
+        except Exception as e:
+            # Creating a station after any other failure would duplicate it
+            if not is_rejected(e):
+                raise
+            logger.exception("Failed to get tracks for station %s." % stationId)
+
+        logger.info("Station %s was rejected, creating a new station." % stationId)
+        self.station_queues.pop(stationId, None)
+        if self.station_seeds.get(seed) == stationId:
+            del self.station_seeds[seed]
+
+        stationId = self.get_station_id(name, **kwargs)
+        return (stationId, self.get_station_tracks(stationId, num_tracks))
+
+    def get_station_queue(self, stationId):
+        if stationId not in self.station_queues:
+            return self.station_queues.setdefault(stationId, StationQueue(self, stationId))
+        return self.station_queues[stationId]
 
     def get_station_tracks(self, stationId, num_tracks=25):
-        tracks = self.get_library_client().get_station_tracks(stationId, num_tracks)
-        return map(lambda t: get_track_for_data(self, t, False), tracks)
+        return self.get_station_queue(stationId).take(num_tracks)
+
+    # Fills the buffers for the first few of the given stations in the
+    # background
+    def prefetch_station_tracks(self, stationIds):
+        queues = map(lambda id: self.get_station_queue(id), stationIds[:PREFETCH_STATIONS])
+
+        def prefetch():
+            set_background(True)
+            for queue in filter(lambda q: len(q.tracks) == 0, queues):
+                try:
+                    queue.fill()
+                except:
+                    logger.exception("Failed to prefetch station %s." % queue.stationId)
+
+        thread = threading.Thread(target=prefetch)
+        thread.daemon = True
+        thread.start()
 
     def load_listen_situations(self):
         situations = self.get_library_client().get_listen_now_situations()
         logger.info("Found %d situations" % len(situations))
 
-        def build_situation(data):
-            sit = {}
+        store = SituationStore()
+
+        def build_situation(data, parent):
+            # Situations are referenced in callbacks by this short key
+            sit = {
+                "id": hash("%s/%s" % (parent, data["title"]))[:12]
+            }
 
             for prop in ["title", "imageUrl", "wideImageUrl"]:
                 sit[prop] = data[prop]
@@ -286,39 +819,102 @@ class Library(object):
                         "art": get_art_for_data(station)
                     })
             elif "situations" in data:
-                sit["situations"] = [build_situation(d) for d in data["situations"]]
+                children = [build_situation(d, sit["id"]) for d in data["situations"]]
+                sit["situations"] = filter(lambda s: s is not None, children)
             else:
                 logger.error("Unexpected keys in situation: %s", repr(data.keys()))
                 return None
 
+            store.situation_by_id[sit["id"]] = sit
             return sit
 
-        return filter(lambda s: s is not None, [build_situation(d) for d in situations])
+        roots = [build_situation(d, "") for d in situations]
+        store.situations = filter(lambda s: s is not None, roots)
+        return store
+
+    def get_situation_store(self):
+        store = self.situations
+        if store is not None and time.time() - store.loaded < SITUATION_TTL:
+            return store
+
+        with self.situation_lock:
+            # Another thread may have loaded them while we waited
+            if self.situations is store:
+                self.situations = self.load_listen_situations()
+            return self.situations
 
     def get_listen_situations(self):
-        if self.situations is None:
-            self.situations = self.load_listen_situations()
-        return self.situations
+        return self.get_situation_store().situations
+
+    def get_listen_situation(self, situationId):
+        return self.get_situation_store().situation_by_id.get(situationId)
+
+
+# The listen now situations for a library, stored by ID.
+class SituationStore(object):
+    situations = None
+    situation_by_id = None
+    loaded = None
+
+    def __init__(self):
+        self.situations = []
+        self.situation_by_id = {}
+        self.loaded = time.time()
+
 
 class Playlist(object):
+    library = None
     data = None
-    track_ids = None
+
+    # The catalog keys of the playlist's entries. The playlist references its
+    # tracks so their keys can't be reused.
+    track_keys = None
+
+    # The snapshot the playlist was built in. Its keys are resolved there so a
+    # request still using the playlist after it is replaced gets its tracks.
+    catalog = None
 
     def __init__(self, library, data):
+        self.library = library
         self.data = data
-        self.track_ids = []
-        library.playlist_by_id[self.id] = self
+        self.track_keys = array("i")
+        self.catalog = snapshot()
+        library.contents.set_playlist(self)
 
+    # Keys are saved as raw bytes and mapped back to track IDs with the saved
+    # track IDs for each key when loaded.
     def pickle(self):
         return {
             "data": self.data,
-            "tracks": self.track_ids
+            "rows": self.track_keys.tostring()
         }
 
     @classmethod
-    def unpickle(cls, library, data):
+    def unpickle(cls, library, data, track_rows):
         playlist = cls(library, data["data"])
-        playlist.track_ids = data["tracks"]
+        if "rows" in data:
+            rows = array("i")
+            rows.fromstring(data["rows"])
+            trackIds = map(lambda row: track_rows[row], rows)
+        else:
+            trackIds = data["tracks"]
+
+        catalog = snapshot()
+        for trackId in trackIds:
+            track = catalog.get_item("track", trackId)
+            if track is not None:
+                playlist.add_track(track.key)
+
+    def add_track(self, trackKey):
+        catalog = snapshot()
+        catalog.add_reference(trackKey)
+        self.track_keys.append(trackKey)
+        self.library.add_track_record(catalog.tracks[trackKey])
+
+    def release(self):
+        catalog = snapshot()
+        for trackKey in self.track_keys:
+            catalog.remove_reference(trackKey)
 
     @property
     def id(self):
@@ -330,4 +926,5 @@ class Playlist(object):
 
     @property
     def tracks(self):
-        return map(lambda id: track_by_id[id], self.track_ids)
+        tracks = self.catalog.tracks
+        return map(lambda key: tracks[key], self.track_keys)
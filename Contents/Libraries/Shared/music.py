@@ -13,135 +13,329 @@
 # limitations under the License.
 
 import logging
+import threading
+import time
 
 from urlparse import urlsplit, parse_qs
 
 import pathset  # NOQA
 
-from genre import Genre
+from genre import Genre, FakeGenre
 from track import Track
-from album import Album, LibraryAlbum
-from artist import Artist, LibraryArtist
+from album import Album, fake_album_ids
+from artist import Artist, fake_artist_ids
 from library import Library
+from connections import log_stats
+from throttle import set_background
+from utils import LRUCache
 from globals import *
 
 logger = logging.getLogger("googlemusicchannel.music")
 
 DB_SCHEMA = 1
 
+# Genres almost never change so are only refreshed once a day.
+GENRE_INTERVAL = 60 * 60 * 24
+
+# The time that genres were last successfully updated and the time that
+# updating them last failed.
+genres_updated = 0
+genres_failed = 0
+
+# The albums added to the catalog by the last refresh.
+added_albums = []
+
+# Called with the data to persist while a long update is in progress.
+checkpoint_saver = None
+
+# Plex resolves the same item URLs over and over
+URL_CACHE_SIZE = 500
+url_cache = LRUCache(URL_CACHE_SIZE)
+
 
 def load_from(data):
     if data["schema"] != DB_SCHEMA:
         return
 
-    for d in data["genres"]:
-        Genre.unpickle(d)
-    for d in data["artists"]:
-        Artist.unpickle(d)
-    for d in data["albums"]:
-        Album.unpickle(d)
-    for d in data["tracks"]:
-        Track.unpickle(d)
-    for l in data["libraries"]:
-        Library.unpickle(l)
+    global genres_updated
+    genres_updated = data.get("genres_updated", 0)
 
+    fake_album_ids.update(data.get("fake_album_ids", {}))
+    fake_artist_ids.update(data.get("fake_artist_ids", {}))
 
-def set_credentials(username, password):
-    if len(libraries) == 1:
-        lib = libraries.values()[0]
+    staging = begin_update()
+    try:
+        for d in data["genres"]:
+            Genre.unpickle(d)
+        for d in data["artists"]:
+            Artist.unpickle(d)
+        for d in data["albums"]:
+            Album.unpickle(d)
+        for d in data["tracks"]:
+            Track.unpickle(d)
+        for l in data["libraries"]:
+            Library.unpickle(l, data.get("track_rows"))
 
-        if lib.username == username and lib.password == password:
-            return
+        staging.collect()
+        publish(staging)
+    finally:
+        stage(None)
 
-        lib.logout()
-        libraries.clear()
 
-    if username is None or password is None:
-        return
+# Takes a list of (username, password) pairs, one for each account slot. The
+# position in the list is used as the library ID.
+def set_credentials(accounts):
+    for (id, (username, password)) in enumerate(accounts):
+        if id in libraries:
+            lib = libraries[id]
 
-    Library(username, password)
+            if lib.username == username and lib.password == password:
+                continue
 
+            lib.logout()
+            del libraries[id]
 
-def refresh():
-    if len(libraries) == 0:
-        return None
+        if not username or not password:
+            continue
+
+        Library(id, username, password)
+
+
+def pickle_sessions():
+    return map(lambda l: l.pickle_session(), libraries.values())
+
+
+# Sessions are only restored for libraries still using the same account
+def load_sessions(data):
+    for d in data:
+        if d["id"] in libraries:
+            libraries[d["id"]].unpickle_session(d)
+
+
+def sessions_changed():
+    return True in map(lambda l: l.session_changed, libraries.values())
+
+
+def set_checkpoint_saver(saver):
+    global checkpoint_saver
+    checkpoint_saver = saver
+
+
+# Persists the snapshot being built. Everything resolved so far is saved with
+# the normal data so after a restart the next update finds those tracks,
+# albums and artists already known and doesn't look them up again.
+def save_checkpoint(staging):
+    try:
+        checkpoint_saver(pickle(staging))
+        logger.info("Saved update progress.")
+    except:
+        logger.exception("Failed to save update progress.")
+
+
+# Failures are retried after RETRY_INTERVAL rather than on every check
+def is_genres_due(now):
+    if now - genres_failed < RETRY_INTERVAL:
+        return False
+    return now - genres_updated >= GENRE_INTERVAL
+
+
+def is_update_due():
+    now = time.time()
+    if is_genres_due(now):
+        return True
+    return True in map(lambda l: l.is_update_due(now), libraries.values())
+
+
+# Builds an item from the published snapshot in the snapshot being updated,
+# along with its album and artist. Returns the item in the current snapshot.
+def carry_over(kind, item):
+    existing = snapshot().get_item(kind, item.id)
+    if existing is not None:
+        return existing
+
+    if kind == "artist":
+        return Artist(item.data)
+    if kind == "album":
+        return Album(item.data, carry_over("artist", item.artist))
+
+    return Track(item.data, carry_over("album", item.album))
 
+
+# Station tracks that request threads added to the published snapshot while
+# the update ran are built again in the new snapshot so their URLs keep
+# working. The old snapshot stays locked until the swap so none are missed.
+def publish_update(staging):
+    previous = published()
+    with previous.lock:
+        for (kind, item) in previous.added[staging.copied_added:]:
+            carry_over(kind, item)
+        publish(staging)
+
+
+def update_genres(client):
     logger.info("Updating genres.")
 
+    catalog = snapshot()
+    genre_by_id = catalog.genre_by_id
+    genre_by_name = catalog.genre_by_name
+
     g_root = []
     g_ids = set()
     g_names = set()
 
     def find_genres(parent, list):
-        genres = libraries.values()[0].get_library_client().get_genres(parent)
+        genres = client.get_genres(parent)
         for data in genres:
             genre = Genre(data)
             list.append(genre)
             genre_by_id[data["id"]] = genre
-            genre_by_name[genre.name] = genre
+            catalog.add_genre(genre)
             g_ids.add(data["id"])
             g_names.add(genre.name)
 
             find_genres(data["id"], genre.children)
 
-    try:
-        find_genres(None, g_root)
-    except:
-        logger.error("Failed to update genres")
+    find_genres(None, g_root)
 
     bad = set(genre_by_id.keys()) - g_ids
     for id in bad:
         del genre_by_id[id]
 
-    bad = set(genre_by_name.keys()) - g_names
+    # Genres that only exist on uploaded tracks aren't returned by the service
+    fakes = filter(lambda g: isinstance(g, FakeGenre), catalog.root_genres)
+    bad = set(genre_by_name.keys()) - g_names - set(map(lambda g: g.name, fakes))
     for name in bad:
-        del genre_by_name[name]
+        catalog.remove_genre(name)
 
-    root_genres = g_root
+    catalog.root_genres = g_root + fakes
     logger.info("Found %d genres." % (len(genre_by_id)))
 
-    for library in libraries.values():
-        library.update()
+
+# Runs whichever update phases are due. Returns the data to persist or None if
+# nothing was updated.
+def refresh(force=False):
+    global added_albums
+
+    if len(libraries) == 0:
+        return None
+
+    # Copying the catalog is expensive so is only done when there is work
+    if not force and not is_update_due():
+        return None
+
+    # Everything is built in a new snapshot which is only published once the
+    # update is complete.
+    previous = published()
+    staging = begin_update()
+    if checkpoint_saver is not None:
+        staging.checkpoint_handler = save_checkpoint
+    set_background(True)
+    try:
+        if not update(staging, force):
+            return None
+
+        publish_update(staging)
+    finally:
+        stage(None)
+        set_background(False)
+
+    added_albums = filter(lambda a: previous.get_item("album", a.id) is None,
+                          staging.get_items("album"))
+
+    return pickle(staging)
+
+
+def update(staging, force):
+    global genres_updated, genres_failed
+
+    updated = False
+    if force or is_genres_due(time.time()):
+        try:
+            update_genres(libraries.values()[0].get_library_client())
+            genres_updated = time.time()
+            updated = True
+        except:
+            logger.exception("Failed to update genres")
+            genres_failed = time.time()
+
+    # Each library updates on its own thread, all building the same snapshot.
+    results = {}
+
+    def update_library(library):
+        stage(staging)
+        set_background(True)
+        try:
+            results[library.id] = library.update(force)
+        except:
+            logger.exception("Failed to update library %d." % library.id)
+        finally:
+            stage(None)
+
+    threads = map(lambda l: threading.Thread(target=update_library, args=(l,)),
+                  libraries.values())
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if True in results.values():
+        updated = True
+
+    if not updated:
+        return False
+
+    for id in set(staging.library_contents.keys()) - set(libraries.keys()):
+        staging.library_contents.pop(id).release()
 
     # As part of the update process some unused records are created
-    logger.debug("Purging unreferenced records.")
-    tracks = set()
-    albums = set()
-    artists = set()
-    for library in libraries.values():
-        for track in library.get_tracks():
-            tracks.add(track)
-        for playlist in library.get_playlists():
-            for track in playlist.tracks:
-                tracks.add(track)
-
-    for track in tracks:
-        albums.add(track.album.id)
-        artists.add(track.artist.id)
-    tracks = set(map(lambda t: t.id, tracks))
-
-    def purge(list, used, name):
-        unwanted = set(list.keys()) - used
-        if len(unwanted) == 0:
-            return
-        for item in unwanted:
-            del list[item]
-        logger.debug("Purged %d unreferenced %s." % (len(unwanted), name))
-
-    purge(track_by_id, tracks, "tracks")
-    purge(album_by_id, albums, "albums")
-    purge(artist_by_id, artists, "artists")
+    count = staging.collect()
+    prune_fake_ids(staging)
+    logger.debug("Purged %d unreferenced records." % count)
+    log_stats()
+
+    return True
+
+
+# Returns the made up IDs in ids that are used by the catalog
+def get_used_ids(ids, kind, catalog):
+    used = catalog.keys[kind].keys
+    return dict([(k, id) for (k, id) in ids.items() if id in used])
+
+
+# Station tracks make up albums and artists on every page so the remembered
+# IDs are pruned to those still in the catalog after each update.
+def prune_fake_ids(catalog):
+    for (ids, kind) in [(fake_album_ids, "album"), (fake_artist_ids, "artist")]:
+        used = get_used_ids(ids, kind, catalog)
+        for k in ids.keys():
+            if k not in used:
+                ids.pop(k, None)
+
+
+def pickle(catalog):
+    # Only keep the made up IDs that are still in use
+    album_ids = get_used_ids(fake_album_ids, "album", catalog)
+    artist_ids = get_used_ids(fake_artist_ids, "artist", catalog)
 
     return {
         "schema": DB_SCHEMA,
-        "genres": map(lambda g: g.pickle(), root_genres),
+        "genres_updated": genres_updated,
+        "genres": map(lambda g: g.pickle(), catalog.root_genres),
         "libraries": map(lambda l: l.pickle(), libraries.values()),
-        "tracks": map(lambda t: t.pickle(), track_by_id.values()),
-        "albums": map(lambda a: a.pickle(), album_by_id.values()),
-        "artists": map(lambda a: a.pickle(), artist_by_id.values())
+        # Playlists refer to tracks by key so this must come after them
+        "track_rows": list(catalog.keys["track"].ids),
+        "tracks": map(lambda t: t.pickle(), catalog.get_items("track")),
+        "albums": map(lambda a: a.pickle(), catalog.get_items("album")),
+        "artists": map(lambda a: a.pickle(), catalog.get_items("artist")),
+        "fake_album_ids": album_ids,
+        "fake_artist_ids": artist_ids
     }
 
 
+def get_libraries():
+    return sorted(libraries.values(), key=lambda l: l.id)
+
+
 def get_library(id):
     try:
         return libraries[int(id)]
@@ -150,48 +344,61 @@ def get_library(id):
 
 
 def get_genre(name):
-    return genre_by_name[name]
+    return snapshot().genre_by_name[name]
 
 
 def get_artist(id, library=None):
-    artist = artist_by_id[id]
+    artist = snapshot().get_item("artist", id)
     if library is not None:
-        return LibraryArtist(library, artist)
+        return library.get_artist_view(artist)
     return artist
 
 
 def get_album(id, library=None):
-    album = album_by_id[id]
+    album = snapshot().get_item("album", id)
     if library is not None:
-        return LibraryAlbum(library, album)
+        return library.get_album_view(album)
     return album
 
 
 def get_track(id):
-    return track_by_id[id]
+    return snapshot().get_item("track", id)
 
 
-def get_item_for_url(url):
+# Returns the (library ID, item ID) for an item URL
+def parse_item_url(url):
+    parsed = url_cache.get(url)
+    if parsed is not None:
+        return parsed
+
     if url[0:len(base_path)] != base_path:
         raise Exception("Failed to match url '%s'" % url)
 
     parts = urlsplit(url[len(base_path):])
-    id = parts.path
     args = parse_qs(parts.query)
 
-    lid = int(args["u"][0])
+    parsed = (int(args["u"][0]), parts.path)
+    url_cache.put(url, parsed)
+    return parsed
+
+
+def get_item_for_url(url):
+    (lid, id) = parse_item_url(url)
+
     if lid not in libraries:
         raise Exception("Couldn't find a library for id '%d'" % lid)
     library = get_library(lid)
 
-    if id in artist_by_id:
-        return library, get_artist(id, library)
-    if id in album_by_id:
-        return library, get_album(id, library)
-    if id in track_by_id:
-        return library, track_by_id[id]
+    found = snapshot().find_item(id)
+    if found is None:
+        raise Exception("ID '%s' didn't match any known item." % id)
 
-    raise Exception("ID '%s' didn't match any known item." % id)
+    (kind, item) = found
+    if kind == "artist":
+        return library, library.get_artist_view(item)
+    if kind == "album":
+        return library, library.get_album_view(item)
+    return library, item
 
 
 # There is a bug in the Plex API that causes albums to return as <Object>
@@ -13,12 +13,24 @@
 # limitations under the License.
 
 import logging
+import threading
 
 from globals import *
+from track import get_track_for_data
 from utils import get_art_for_data, get_thumb_for_data
+from throttle import set_background
 
 logger = logging.getLogger("googlemusicchannel.library")
 
+# Station tracks are slow to fetch so a buffer of upcoming tracks is kept for
+# each station. Once it drops below the low water mark it is refilled in the
+# background.
+LOW_WATER = 50
+REFILL_SIZE = 50
+
+# Only the first few stations in a list are filled ahead of being opened.
+PREFETCH_STATIONS = 3
+
 
 class Station(object):
     library = None
@@ -54,3 +66,72 @@ class Station(object):
     @property
     def thumb(self):
         return get_thumb_for_data(self.data)
+
+
+class StationQueue(object):
+    library = None
+    stationId = None
+
+    # Raw track data for the upcoming tracks
+    tracks = None
+    filling = False
+    lock = None
+
+    def __init__(self, library, stationId):
+        self.library = library
+        self.stationId = stationId
+        self.tracks = []
+        self.lock = threading.Lock()
+
+    # Fetches more tracks from the server into the buffer
+    def fetch(self, count):
+        client = self.library.get_library_client()
+        data = client.get_station_tracks(self.stationId, count)
+
+        with self.lock:
+            ids = set(map(lambda t: t["id"], self.tracks))
+            self.tracks.extend(filter(lambda t: t["id"] not in ids, data))
+
+    # Like fetch but does nothing if a fill is already in progress
+    def fill(self):
+        with self.lock:
+            if self.filling:
+                return
+            self.filling = True
+
+        try:
+            self.fetch(REFILL_SIZE)
+        finally:
+            self.filling = False
+
+    def refill(self):
+        with self.lock:
+            if self.filling or len(self.tracks) >= LOW_WATER:
+                return
+
+        def fill():
+            set_background(True)
+            try:
+                self.fill()
+            except:
+                logger.exception("Failed to refill station %s." % self.stationId)
+
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+
+    # Returns up to count tracks from the buffer, only going to the server
+    # directly if the buffer doesn't have enough.
+    def take(self, count):
+        missing = count - len(self.tracks)
+        if missing > 0:
+            self.fetch(max(missing, REFILL_SIZE))
+
+        with self.lock:
+            page = self.tracks[:count]
+            del self.tracks[:count]
+
+        self.refill()
+
+        # Only the raw data is buffered, tracks are built as they are taken
+        return map(lambda t: get_track_for_data(self.library, t, False), page)
@@ -0,0 +1,353 @@
+# Copyright 2016 Dave Townsend
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import random
+import threading
+import time
+import types
+
+from requests.exceptions import ConnectionError, Timeout
+from gmusicapi.exceptions import CallFailure
+
+logger = logging.getLogger("googlemusicchannel.throttle")
+
+# Client methods that don't talk to the server
+LOCAL_METHODS = set(["is_authenticated", "logout"])
+
+# Failures from these methods never trigger logging in again
+AUTH_METHODS = set(["login"])
+
+# Methods that change something on the server. A call that timed out may still
+# have succeeded so these are never retried.
+UNSAFE_METHODS = set(["create_station", "login"])
+
+# Calls that fail with a transient error are retried after a random delay of
+# up to BASE_DELAY * 2^attempt seconds, capped at MAX_DELAY.
+MAX_ATTEMPTS = 4
+BASE_DELAY = 0.5
+MAX_DELAY = 8
+
+# After this many consecutive transient failures calls to an endpoint class
+# fail immediately until RESET_TIMEOUT seconds have passed. A single call is
+# then allowed through to test whether the server has recovered.
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+
+# Returns the HTTP status of a failed call as a string or None. The message of
+# a CallFailure starts with the status but str() puts the call name first.
+def get_status(e):
+    if not isinstance(e, CallFailure) or len(e.args) == 0:
+        return None
+
+    code = e.args[0][0:3]
+    if code.isdigit():
+        return code
+    return None
+
+
+# Whether a call failed because the server rejected the client's session
+def is_auth_failure(e):
+    return get_status(e) in ["401", "403"]
+
+
+# Whether the server refused the request itself, trying again won't help
+def is_rejected(e):
+    code = get_status(e)
+    return code is not None and code[0] == "4" and code != "429"
+
+
+# Whether a call failed in a way that may succeed if tried again
+def is_transient_failure(e):
+    if isinstance(e, (ConnectionError, Timeout)):
+        return True
+    code = get_status(e)
+    return code is not None and (code == "429" or code[0] == "5")
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    name = None
+
+    failures = 0
+    opened = None
+    testing = False
+    lock = None
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    # Raises CircuitOpen if calls should not be attempted
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+
+            if self.testing or time.time() - self.opened < RESET_TIMEOUT:
+                raise CircuitOpen("Too many failures calling %s endpoints." % self.name)
+
+            self.testing = True
+
+    def succeeded(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info("Calls to %s endpoints are succeeding again." % self.name)
+            self.failures = 0
+            self.opened = None
+            self.testing = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.testing = False
+            if self.opened is None and self.failures < FAILURE_THRESHOLD:
+                return
+
+            if self.opened is None:
+                logger.warning("Pausing calls to %s endpoints after %d failures." %
+                               (self.name, self.failures))
+            self.opened = time.time()
+
+
+# Every client method that reaches the server is assigned to a class of
+# endpoint. Each class has its own rate limit so that a burst of catalog
+# lookups during an update can't starve playback.
+ENDPOINTS = {
+    "get_stream_url": "stream",
+    "get_station_tracks": "station",
+    "create_station": "station",
+    "get_all_stations": "station",
+    "get_listen_now_situations": "station",
+    "get_genres": "catalog",
+    "get_album_info": "catalog",
+    "get_artist_info": "catalog",
+    "get_track_info": "catalog",
+}
+DEFAULT_ENDPOINT = "library"
+
+# The most calls that may be waiting on the server at once
+MAX_IN_FLIGHT = 4
+
+# How long background calls wait before checking whether foreground calls
+# still need a token
+BACKGROUND_POLL = 0.1
+
+_local = threading.local()
+
+
+def is_background():
+    return getattr(_local, "background", False)
+
+
+# Marks calls made by the current thread as background work. These wait for
+# any waiting foreground calls to go first.
+def set_background(background):
+    _local.background = background
+
+
+# A token bucket shared by every thread. Tokens are added at a fixed rate up to
+# a maximum burst size and each call consumes one. Background calls only get a
+# token when no foreground call is waiting for one.
+class RateLimiter(object):
+    rate = None
+    burst = None
+
+    tokens = None
+    updated = None
+    waiting = 0
+    lock = None
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    # Blocks until a token is available and consumes it
+    def acquire(self, foreground=True):
+        if foreground:
+            with self.lock:
+                self.waiting += 1
+
+        try:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1 and (foreground or self.waiting == 0):
+                        self.tokens -= 1
+                        return
+
+                    wait = max((1 - self.tokens) / self.rate, BACKGROUND_POLL)
+
+                time.sleep(wait)
+        finally:
+            if foreground:
+                with self.lock:
+                    self.waiting -= 1
+
+
+# Limits the number of calls in progress at once. Background calls only start
+# when no foreground call is waiting to.
+class Governor(object):
+    limit = None
+
+    in_flight = 0
+    waiting = 0
+    condition = None
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.condition = threading.Condition()
+
+    def acquire(self, foreground=True):
+        with self.condition:
+            if foreground:
+                self.waiting += 1
+
+            try:
+                while (self.in_flight >= self.limit or
+                       (not foreground and self.waiting > 0)):
+                    self.condition.wait()
+            finally:
+                if foreground:
+                    self.waiting -= 1
+
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+# All libraries share these so that updating several accounts at once doesn't
+# hit the server any harder than updating one.
+limiters = {
+    "stream": RateLimiter(5, 10),
+    "station": RateLimiter(2, 5),
+    "catalog": RateLimiter(5, 10),
+    "library": RateLimiter(2, 5),
+}
+governor = Governor(MAX_IN_FLIGHT)
+breakers = dict([(e, CircuitBreaker(e)) for e in limiters.keys()])
+
+
+def acquire(endpoint, foreground):
+    breakers[endpoint].check()
+    limiters[endpoint].acquire(foreground)
+    governor.acquire(foreground)
+
+
+def throttled_call(endpoint, attempts, method, *args, **kwargs):
+    foreground = not is_background()
+    breaker = breakers[endpoint]
+
+    attempt = 0
+    while True:
+        acquire(endpoint, foreground)
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            if not is_transient_failure(e):
+                # The server is responding, it just didn't like this call
+                breaker.succeeded()
+                raise
+
+            breaker.failed()
+            attempt += 1
+            if attempt >= attempts:
+                raise
+
+            delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+            logger.warning("Call to %s failed (%s), retrying in %.1f seconds." %
+                           (method.__name__, str(e).split("\n")[0], delay))
+        else:
+            breaker.succeeded()
+            return result
+        finally:
+            governor.release()
+
+        time.sleep(delay)
+
+
+# Incremental listings return a generator that makes a request for each page.
+# Each page is throttled like a call but can't be retried because the
+# generator is finished once it has raised.
+def throttled_pages(endpoint, pages):
+    foreground = not is_background()
+    breaker = breakers[endpoint]
+
+    while True:
+        acquire(endpoint, foreground)
+        try:
+            page = next(pages)
+        except StopIteration:
+            return
+        except Exception as e:
+            if is_transient_failure(e):
+                breaker.failed()
+            raise
+        finally:
+            governor.release()
+
+        breaker.succeeded()
+        yield page
+
+
+# Wraps a Mobileclient so that every call that reaches the server is rate
+# limited and counts towards the in-flight limit. If the server rejects the
+# client's session the reauthenticate callback is called with this client and
+# the call is retried once.
+class ThrottledClient(object):
+    client = None
+    reauthenticate = None
+
+    def __init__(self, client, reauthenticate=None):
+        self.client = client
+        self.reauthenticate = reauthenticate
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in LOCAL_METHODS:
+            return attr
+
+        endpoint = ENDPOINTS.get(name, DEFAULT_ENDPOINT)
+        attempts = 1 if name in UNSAFE_METHODS else MAX_ATTEMPTS
+
+        def call(*args, **kwargs):
+            try:
+                result = throttled_call(endpoint, attempts, attr, *args, **kwargs)
+            except Exception as e:
+                if (self.reauthenticate is None or name in AUTH_METHODS or
+                        not is_auth_failure(e)):
+                    raise
+
+                # The server rejected the call so it is safe to make again
+                self.reauthenticate(self)
+                result = throttled_call(endpoint, attempts, attr, *args, **kwargs)
+
+            if isinstance(result, types.GeneratorType):
+                return throttled_pages(endpoint, result)
+            return result
+
+        return call
@@ -22,35 +22,57 @@ from genre import FakeGenre
 logger = logging.getLogger("googlemusicchannel.track")
 
 
+# Tracks are ordered within an album by disc and then track number
+def get_sort_key(data):
+    return int(data.get("discNumber", 0)) * 1000 + int(data.get("trackNumber", 0))
+
+
+# Timestamps are given in microseconds
+def get_timestamp(data, field):
+    return int(data.get(field, 0)) / 1000000.0
+
+
+# Tracks hold their album rather than looking it up by key in the current
+# snapshot. A request that is still using a track after a newer snapshot is
+# published then sees the track's own album even if it has since been purged.
 class Track(object):
     data = None
-    albumId = None
+    key = None
+    album = None
+    genreKey = -1
+    sort_key = None
 
-    def __init__(self, data):
+    def __init__(self, data, album):
         self.data = data
-        track_by_id[self.id] = self
+        self.album = album
+        self.sort_key = get_sort_key(data)
+        catalog = snapshot()
 
+        genre = None
         if "genre" in data:
-            if data["genre"] in genre_by_name:
-                genre = genre_by_name[data["genre"]]
-                if isinstance(genre, FakeGenre):
-                    genre.examples.append(self)
-            else:
-                genre = FakeGenre(data["genre"])
-                genre.examples.append(self)
-                genre_by_name[data["genre"]] = genre
-                root_genres.append(genre)
+            # Another library may be creating the same genre in parallel
+            with catalog.lock:
+                genre = catalog.genre_by_name.get(data["genre"])
+                if genre is None:
+                    genre = FakeGenre(data["genre"])
+                    catalog.add_genre(genre)
+                    catalog.root_genres.append(genre)
+            self.genreKey = genre.key
+
+        catalog.add_item("track", self)
+
+        if isinstance(genre, FakeGenre):
+            genre.add_example(self)
 
     @classmethod
     def unpickle(cls, data):
-        if data["albumId"] not in album_by_id:
-            logger.error("Refusing to unpickle track with no valid album (%s by %d)." %
-                         (data["title"], data["albumArtist"]))
+        album = snapshot().get_item("album", data["albumId"])
+        if album is None:
+            logger.error("Refusing to unpickle track with no valid album (%s by %s)." %
+                         (data["data"]["title"], data["data"]["albumArtist"]))
             return
 
-        track = cls(data["data"])
-        track.albumId = data["albumId"]
-        return track
+        return cls(data["data"], album)
 
     def pickle(self):
         return {
@@ -62,9 +84,7 @@ class Track(object):
         if not isinstance(other, Track):
             raise Exception("Cannot compare a Track to %s" % repr(other))
 
-        if self.data["discNumber"] != other.data["discNumber"]:
-            return self.data["discNumber"] - other.data["discNumber"]
-        return self.data["trackNumber"] - other.data["trackNumber"]
+        return self.sort_key - other.sort_key
 
     # Public API
     @property
@@ -72,16 +92,22 @@ class Track(object):
         return self.data["id"]
 
     @property
-    def artist(self):
-        return self.album.artist
+    def albumId(self):
+        return self.album.id
 
     @property
-    def album(self):
-        return album_by_id[self.albumId]
+    def albumKey(self):
+        return self.album.key
+
+    @property
+    def artist(self):
+        return self.album.artist
 
     @property
     def genre(self):
-        return genre_by_name[self.data["genre"]]
+        if self.genreKey < 0:
+            return None
+        return snapshot().genres[self.genreKey]
 
     @property
     def title(self):
@@ -103,6 +129,24 @@ class Track(object):
     def duration(self):
         return int(self.data["durationMillis"])
 
+    # The values for the track's row in the catalog's track table
+    def get_columns(self):
+        return {
+            "duration": self.duration,
+            "disc": int(self.data.get("discNumber", 0)),
+            "track": int(self.data.get("trackNumber", 0)),
+            "album": self.albumKey,
+            "artist": self.album.artistKey,
+            "genre": self.genreKey,
+        }
+
+    # The fields needed to list the track in a library as (title, artist name,
+    # album name, duration, thumb, url)
+    def get_record(self, library):
+        album = self.album
+        return (self.title, album.artist.name, album.name, self.duration, album.thumb,
+                self.get_url(library))
+
     def get_url(self, library):
         param = urlize("%s - %s" % (self.title, self.artist.name))
 
@@ -115,15 +159,25 @@ class Track(object):
 
         return url
 
+# The values for a track's row in a library's track table. These differ
+# between accounts so come from the library's own listing of the track.
+def get_library_columns(data):
+    return {
+        "added": get_timestamp(data, "creationTimestamp"),
+        "modified": get_timestamp(data, "lastModifiedTimestamp"),
+        "plays": int(data.get("playCount", 0)),
+    }
+
+
 def get_track_for_data(library, track_data, lookups=True):
     if "nid" in track_data:
         track_data["id"] = track_data["nid"]
 
-    if track_data["id"] in track_by_id:
-        return track_by_id[track_data["id"]]
+    track = snapshot().get_item("track", track_data["id"])
+    if track is not None:
+        return track
 
-    track = Track(track_data)
+    # Other threads may see the track as soon as it is created so the album must
+    # be known first
     album = get_album_for_track(library.get_library_client(), track_data, lookups)
-    track.albumId = album.id
-
-    return track
+    return Track(track_data, album)
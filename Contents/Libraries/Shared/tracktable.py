@@ -0,0 +1,261 @@
+# Copyright 2016 Dave Townsend
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+from array import array
+
+# NumPy isn't available inside Plex but speeds up aggregation when it is.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger("googlemusicchannel.tracktable")
+
+# The columns of the catalog's table and their array type codes. The album,
+# artist and genre columns hold the catalog keys of the track's album, artist
+# and genre, -1 if unknown.
+COLUMNS = [
+    ("live", "b"),
+    ("duration", "l"),
+    ("disc", "i"),
+    ("track", "i"),
+    ("album", "i"),
+    ("artist", "i"),
+    ("genre", "i"),
+]
+
+# The columns of a library's table. These differ between accounts listing the
+# same track so each library keeps its own rows keyed by library track ID. The
+# key column holds the catalog key of the track.
+LIBRARY_COLUMNS = [
+    ("live", "b"),
+    ("key", "i"),
+    ("added", "d"),
+    ("modified", "d"),
+    ("plays", "i"),
+]
+
+
+# Assigns dense integer keys to IDs. The keys of removed IDs are reused so the
+# keys stay close to the number of IDs in use. Something may still hold a
+# removed key for a while, so keys can be held back for reuse_delay seconds,
+# after which release makes them available again.
+class KeyMap(object):
+    # The ID for each key, None for unused keys, and the key for each ID
+    ids = None
+    keys = None
+    free = None
+
+    # Removed keys that are not yet free as (time removed, key) pairs
+    retired = None
+    reuse_delay = 0
+
+    def __init__(self, reuse_delay=0):
+        self.ids = []
+        self.keys = {}
+        self.free = []
+        self.retired = []
+        self.reuse_delay = reuse_delay
+
+    def copy(self):
+        keymap = KeyMap(self.reuse_delay)
+        keymap.ids = list(self.ids)
+        keymap.keys = dict(self.keys)
+        keymap.free = list(self.free)
+        keymap.retired = list(self.retired)
+        return keymap
+
+    # Returns the key for an ID, assigning one if it doesn't have one yet
+    def add(self, id):
+        key = self.keys.get(id)
+        if key is not None:
+            return key
+
+        if len(self.free) > 0:
+            key = self.free.pop()
+            self.ids[key] = id
+        else:
+            key = len(self.ids)
+            self.ids.append(id)
+        self.keys[id] = key
+        return key
+
+    # Frees the key for an ID. Returns the key or None if the ID had none.
+    def remove(self, id):
+        key = self.keys.pop(id, None)
+        if key is None:
+            return None
+
+        self.ids[key] = None
+        if self.reuse_delay > 0:
+            self.retired.append((time.time(), key))
+        else:
+            self.free.append(key)
+        return key
+
+    # Frees the keys that have been held back for long enough
+    def release(self):
+        before = time.time() - self.reuse_delay
+        self.free.extend(map(lambda r: r[1], filter(lambda r: r[0] < before, self.retired)))
+        self.retired = filter(lambda r: r[0] >= before, self.retired)
+
+    def get_key(self, id):
+        return self.keys.get(id, -1)
+
+    def get_id(self, key):
+        if key < 0:
+            return None
+        return self.ids[key]
+
+
+# Holds the numeric fields of tracks in one array per column so that they can
+# be aggregated and sorted without visiting each track's data. The catalog's
+# table has a row for every track and a track's row is also its key in the
+# catalog. Each library has a table of the fields that depend on the account.
+class TrackTable(object):
+    layout = None
+    columns = None
+
+    # Maps track IDs to rows. Rows of purged tracks are reused by new tracks
+    # once they have been held back for reuse_delay seconds, see KeyMap.
+    rows = None
+
+    lock = None
+
+    def __init__(self, layout=COLUMNS, reuse_delay=0):
+        self.layout = layout
+        self.columns = dict([(name, array(code)) for (name, code) in layout])
+        self.rows = KeyMap(reuse_delay)
+        self.lock = threading.Lock()
+
+    def copy(self):
+        table = TrackTable(self.layout)
+        with self.lock:
+            table.columns = dict([(name, column[:]) for (name, column) in self.columns.items()])
+            table.rows = self.rows.copy()
+        return table
+
+    # Adds or replaces the row for a track and returns the row. values maps
+    # column names to values.
+    def add(self, id, values):
+        with self.lock:
+            row = self.rows.add(id)
+            if row == len(self.columns["live"]):
+                for column in self.columns.values():
+                    column.append(0)
+
+            self.columns["live"][row] = 1
+            for (name, value) in values.items():
+                self.columns[name][row] = value
+
+            return row
+
+    def remove(self, id):
+        with self.lock:
+            row = self.rows.remove(id)
+            if row is not None:
+                self.columns["live"][row] = 0
+
+    # Returns the values of the named columns for an ID as a dict, None if the
+    # ID has no row.
+    def get(self, id, names):
+        with self.lock:
+            row = self.rows.keys.get(id)
+            if row is None:
+                return None
+            return dict([(name, self.columns[name][row]) for name in names])
+
+    # Returns a column's values for the given rows
+    def get_values(self, name, rows):
+        with self.lock:
+            column = self.columns[name]
+            return map(lambda row: column[row], rows)
+
+    # Request threads append rows to the published table, which may move a
+    # column's memory, so views must only be used while holding the lock.
+    def view(self, name):
+        column = self.columns[name]
+        return numpy.frombuffer(column, dtype=numpy.dtype(column.typecode))
+
+    # Returns a dict of the sum of a column for each key in a key column over
+    # the given rows.
+    def sum_by(self, name, key_name, rows):
+        with self.lock:
+            if numpy is not None and len(rows) > 0:
+                selected = numpy.frombuffer(rows, dtype=numpy.intc)
+                keys = self.view(key_name)[selected]
+                values = self.view(name)[selected]
+                known = keys >= 0
+                totals = numpy.bincount(keys[known], weights=values[known])
+                counts = numpy.bincount(keys[known])
+                return dict([(int(k), totals[k]) for k in numpy.nonzero(counts)[0]])
+
+            keys = self.columns[key_name]
+            values = self.columns[name]
+            totals = {}
+            for row in rows:
+                key = keys[row]
+                if key >= 0:
+                    totals[key] = totals.get(key, 0) + values[row]
+            return totals
+
+    # Returns a dict of the number of rows for each key in a key column.
+    def count_by(self, key_name, rows):
+        with self.lock:
+            if numpy is not None and len(rows) > 0:
+                keys = self.view(key_name)[numpy.frombuffer(rows, dtype=numpy.intc)]
+                counts = numpy.bincount(keys[keys >= 0])
+                return dict([(int(k), counts[k]) for k in numpy.nonzero(counts)[0]])
+
+            keys = self.columns[key_name]
+            counts = {}
+            for row in rows:
+                key = keys[row]
+                if key >= 0:
+                    counts[key] = counts.get(key, 0) + 1
+            return counts
+
+    # Returns the rows whose key column holds the given key.
+    def select(self, key_name, key, rows):
+        if key < 0:
+            return array("i")
+
+        with self.lock:
+            if numpy is not None and len(rows) > 0:
+                selected = numpy.frombuffer(rows, dtype=numpy.intc)
+                matches = selected[self.view(key_name)[selected] == key]
+                return array("i", matches.tolist())
+
+            keys = self.columns[key_name]
+            return array("i", filter(lambda row: keys[row] == key, rows))
+
+    # Returns the rows ordered by a column, limited to count rows if given.
+    def sort(self, name, rows, reverse=False, count=None):
+        with self.lock:
+            if numpy is not None and len(rows) > 0:
+                selected = numpy.frombuffer(rows, dtype=numpy.intc)
+                order = numpy.argsort(self.view(name)[selected], kind="mergesort")
+                if reverse:
+                    order = order[::-1]
+                result = selected[order].tolist()
+            else:
+                values = self.columns[name]
+                result = sorted(rows, key=lambda row: values[row], reverse=reverse)
+
+        if count is not None:
+            result = result[:count]
+        return result
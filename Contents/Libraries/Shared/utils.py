@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
 import hashlib
-from base64 import urlsafe_b64encode
+import threading
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict
+from urlparse import urlsplit
 import logging
 
+from Cryptodome.Cipher import AES
+
 logger = logging.getLogger("googlemusicchannel.utils")
 
 
@@ -24,8 +30,89 @@ def urlize(string):
     return re.sub(r'[\W-]+', "_", string)
 
 
+# A thread safe mapping that holds at most size entries, discarding the least
+# recently used when full.
+class LRUCache(object):
+    size = None
+    entries = None
+    lock = None
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def to_bytes(string):
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return string
+
+
+# Titles and names are often unicode, ASCII text hashes the same either way
 def hash(data):
-    return urlsafe_b64encode(hashlib.sha256(data).digest())
+    return urlsafe_b64encode(hashlib.sha256(to_bytes(data)).digest())
+
+
+# Secrets are encrypted with AES-GCM using a key derived from a password by
+# this many rounds of PBKDF2-SHA256. Each secret gets its own salt and nonce.
+KEY_ROUNDS = 100000
+SALT_SIZE = 16
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+def derive_key(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", to_bytes(password), salt, KEY_ROUNDS, 32)
+
+
+# Encrypts and authenticates data with a password. The result is a string safe
+# to store anywhere.
+def encrypt(password, data):
+    salt = os.urandom(SALT_SIZE)
+    nonce = os.urandom(NONCE_SIZE)
+    cipher = AES.new(derive_key(password, salt), AES.MODE_GCM, nonce=nonce)
+    (ciphertext, tag) = cipher.encrypt_and_digest(to_bytes(data))
+    return urlsafe_b64encode(salt + nonce + tag + ciphertext)
+
+
+# Returns the data passed to encrypt or None if the password is wrong or the
+# data was changed
+def decrypt(password, encrypted):
+    try:
+        sealed = urlsafe_b64decode(to_bytes(encrypted))
+    except TypeError:
+        return None
+    if len(sealed) < SALT_SIZE + NONCE_SIZE + TAG_SIZE:
+        return None
+
+    salt = sealed[:SALT_SIZE]
+    nonce = sealed[SALT_SIZE:SALT_SIZE + NONCE_SIZE]
+    tag = sealed[SALT_SIZE + NONCE_SIZE:SALT_SIZE + NONCE_SIZE + TAG_SIZE]
+    cipher = AES.new(derive_key(password, salt), AES.MODE_GCM, nonce=nonce)
+    try:
+        return cipher.decrypt_and_verify(sealed[SALT_SIZE + NONCE_SIZE + TAG_SIZE:], tag)
+    except ValueError:
+        return None
 
 
 def get_album_hash(artist, name):
@@ -34,6 +121,66 @@ def get_album_hash(artist, name):
     return hash("%s:%s" % (artist, name))
 
 
+# The size images are requested at for each way they are displayed.
+IMAGE_SIZES = {
+    "list": (120, 120),
+    "grid": (300, 300),
+    "art": (1280, 720),
+}
+
+
+# Parses a size such as "300" or "1280x720". Returns None if invalid.
+def parse_image_size(value):
+    try:
+        parts = map(int, value.lower().split("x"))
+    except:
+        return None
+
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2 or min(parts) <= 0:
+        return None
+    return tuple(parts)
+
+
+def set_image_size(view, value):
+    size = parse_image_size(value)
+    if size is None:
+        logger.warning("Ignoring invalid %s image size '%s'." % (view, value))
+        return
+    IMAGE_SIZES[view] = size
+
+
+def get_image_url_for_view(url, view):
+    (width, height) = IMAGE_SIZES[view]
+    return get_sized_image_url(url, width, height)
+
+
+# Hosts served by Google's image servers.
+RESIZABLE_HOSTS = ["googleusercontent.com", "ggpht.com"]
+
+
+def is_resizable(url):
+    hostname = urlsplit(url).hostname
+    if hostname is None:
+        return False
+
+    return True in map(lambda h: hostname == h or hostname.endswith("." + h),
+                       RESIZABLE_HOSTS)
+
+
+# Google's image servers will resize an image based on options appended to the
+# URL. Other URLs are returned unchanged.
+def get_sized_image_url(url, width, height):
+    if url is None or not is_resizable(url):
+        return url
+
+    base = url.split("=")[0]
+    if width == height:
+        return "%s=s%d" % (base, width)
+    return "%s=w%d-h%d" % (base, width, height)
+
+
 def get_images_for_data(data, filt=lambda i: True):
     images = []
 